@@ -3,28 +3,47 @@ from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, CursorType, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, ValidationError
 from typing import List, Optional, Literal, Dict, Set
 import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
 import asyncio
 import json
+import time
+import base64
+import hashlib
+import hmac
+import re
+import secrets
+from collections import OrderedDict, deque
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
-EMERGENT_AUTH_URL = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
+EMERGENT_AUTH_URL = os.environ.get('EMERGENT_AUTH_URL', "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data")
+
+# Sessions slide: once past half their lifetime, use pushes expiry a full lifetime out
+SESSION_TTL = timedelta(days=float(os.environ.get('SESSION_TTL_DAYS', '7')))
+# Logins beyond this many live sessions per user evict that user's oldest sessions
+MAX_SESSIONS_PER_USER = int(os.environ.get('MAX_SESSIONS_PER_USER', '10'))
+# "opaque": random tokens looked up in user_sessions. "signed": self-contained HMAC tokens
+# verified without the database (SESSION_SIGNING_KEY must be the same on every worker).
+SESSION_MODE = os.environ.get('SESSION_MODE', 'opaque')
+if SESSION_MODE not in ("opaque", "signed"):
+    raise RuntimeError(f"SESSION_MODE must be 'opaque' or 'signed', got {SESSION_MODE!r}")
 
 class User(BaseModel):
     user_id: str
@@ -56,6 +75,7 @@ class Pulperia(BaseModel):
     logo_url: Optional[str] = None
     rating: Optional[float] = 0.0
     review_count: Optional[int] = 0
+    rating_sum: Optional[int] = 0
     # Customization options
     title_font: Optional[str] = "default"  # default, serif, script, bold
     background_color: Optional[str] = "#DC2626"  # Default red
@@ -74,7 +94,7 @@ class Product(BaseModel):
     created_at: datetime
 
 class OrderItem(BaseModel):
-    product_id: str
+    product_id: str = Field(min_length=1)
     product_name: str
     quantity: int
     price: float
@@ -88,6 +108,7 @@ class Order(BaseModel):
     total: float
     status: Literal["pending", "accepted", "ready", "completed", "cancelled"] = "pending"
     order_type: Literal["online", "pickup"] = "pickup"
+    owner_user_id: Optional[str] = None  # Denormalized from the pulperia for notifications
     created_at: datetime
 
 class Message(BaseModel):
@@ -237,152 +258,1169 @@ class ServiceCreate(BaseModel):
     contact: str
     images: List[str] = []
 
-async def get_current_user(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    token = None
+# ============================================
+# DATABASE INDEXES
+# ============================================
+
+# Every query shape the API issues, per collection. Declared once and created
+# idempotently at startup; `python server.py index-report` compares it with the server.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    "user_sessions": [
+        IndexModel([("session_token", ASCENDING)], unique=True),
+        # Newest-first per user, for the per-user session cap
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        # Only removes documents whose expires_at is a native date
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    # Session-cache invalidations for other workers, kept only as long as a cache entry lives
+    "session_invalidations": [
+        IndexModel([("at", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    # Logged-out signed tokens, kept only until the token would have expired anyway
+    "revoked_sessions": [
+        IndexModel([("jti", ASCENDING)], unique=True),
+        IndexModel([("revoked_at", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "pulperias": [
+        IndexModel([("pulperia_id", ASCENDING)], unique=True),
+        IndexModel([("owner_user_id", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("pulperia_id", DESCENDING)]),
+        IndexModel([("rating", DESCENDING), ("pulperia_id", DESCENDING)]),
+        IndexModel([("geo", "2dsphere")]),
+        IndexModel([("name", TEXT), ("address", TEXT)], weights={"name": 10, "address": 2}, default_language="spanish"),
+    ],
+    "products": [
+        IndexModel([("product_id", ASCENDING)], unique=True),
+        IndexModel([("pulperia_id", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("product_id", DESCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("product_id", DESCENDING)]),
+        IndexModel([("price", ASCENDING), ("product_id", ASCENDING)]),
+        IndexModel([("name", TEXT), ("description", TEXT)], weights={"name": 10, "description": 1}, default_language="spanish"),
+    ],
+    "orders": [
+        IndexModel([("order_id", ASCENDING)], unique=True),
+        IndexModel([("customer_user_id", ASCENDING), ("created_at", DESCENDING), ("order_id", DESCENDING)]),
+        IndexModel([("customer_user_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("pulperia_id", ASCENDING), ("created_at", DESCENDING), ("order_id", DESCENDING)]),
+        IndexModel([("pulperia_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "messages": [
+        IndexModel([("message_id", ASCENDING)], unique=True),
+        IndexModel([("from_user_id", ASCENDING), ("created_at", DESCENDING), ("message_id", DESCENDING)]),
+        IndexModel([("to_user_id", ASCENDING), ("created_at", DESCENDING), ("message_id", DESCENDING)]),
+    ],
+    "reviews": [
+        IndexModel([("review_id", ASCENDING)], unique=True),
+        IndexModel([("pulperia_id", ASCENDING), ("created_at", DESCENDING), ("review_id", DESCENDING)]),
+        # One review per person per pulpería
+        IndexModel([("pulperia_id", ASCENDING), ("user_id", ASCENDING)], unique=True),
+    ],
+    "jobs": [
+        IndexModel([("job_id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("job_id", DESCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("job_id", DESCENDING)]),
+        IndexModel([("pulperia_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("title", TEXT), ("description", TEXT)], weights={"title": 5, "description": 1}, default_language="spanish"),
+    ],
+    "job_applications": [
+        IndexModel([("application_id", ASCENDING)], unique=True),
+        IndexModel([("job_id", ASCENDING), ("applicant_user_id", ASCENDING)]),
+        IndexModel([("job_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "services": [
+        IndexModel([("service_id", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("service_id", DESCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("service_id", DESCENDING)]),
+        IndexModel([("title", TEXT), ("description", TEXT)], weights={"title": 5, "description": 1}, default_language="spanish"),
+    ],
+    "sales_daily": [
+        IndexModel([("pulperia_id", ASCENDING), ("day", ASCENDING)], unique=True),
+    ],
+    "advertisements": [
+        IndexModel([("ad_id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("end_date", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("plan", DESCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("pulperia_id", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("pulperia_id", ASCENDING), ("created_at", DESCENDING), ("ad_id", DESCENDING)]),
+    ],
+}
+
+# IndexOptionsConflict / IndexKeySpecsConflict: same name, different options
+INDEX_CONFLICT_CODES = (85, 86)
+# A unique index build found duplicate keys
+DUPLICATE_KEY_CODE = 11000
+
+# Cleanups that remove legacy duplicates so a unique index can be built over them
+UNIQUE_INDEX_DEDUPES = {
+    # Keeps each person's first review, then recounts the affected ratings
+    ("reviews", "pulperia_id_1_user_id_1"): lambda: repair_rating_counters(),
+    # Keeps the session that lives longest; the others were superseded by re-logins
+    ("user_sessions", "session_token_1"): lambda: dedupe_collection(
+        db.user_sessions, ["session_token"], {"expires_at": -1, "_id": -1}
+    ),
+}
+
+def fallback_index(model: IndexModel) -> IndexModel:
+    """Non-unique twin of a unique index, so lookups stay indexed while duplicates remain"""
+    return IndexModel(list(model.document["key"].items()), name=f"{model.document['name']}_nonunique")
+
+async def dedupe_collection(collection, keys: List[str], keep_first: dict) -> int:
+    """Delete all but the first document (in `keep_first` order) of every group sharing `keys`"""
+    deleted = 0
+    async for group in collection.aggregate([
+        {"$sort": keep_first},
+        {"$group": {"_id": {key: f"${key}" for key in keys}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True):
+        deleted += (await collection.delete_many({"_id": {"$in": group["ids"][1:]}})).deleted_count
+    return deleted
+
+async def has_duplicates(collection, keys: List[str]) -> bool:
+    duplicate = await collection.aggregate([
+        {"$group": {"_id": {key: f"${key}" for key in keys}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 1}
+    ], allowDiskUse=True).to_list(1)
+    return bool(duplicate)
+
+async def create_index(collection_name: str, model: IndexModel):
+    """create_indexes; a unique build over legacy duplicates runs the registered dedupe once,
+    and falls back to a non-unique index (flagged by index-report) if duplicates remain"""
+    collection = db[collection_name]
+    name = model.document["name"]
+    try:
+        await collection.create_indexes([model])
+    except OperationFailure as e:
+        if e.code != DUPLICATE_KEY_CODE:
+            raise
+        dedupe = UNIQUE_INDEX_DEDUPES.get((collection_name, name))
+        try:
+            if dedupe is None:
+                raise
+            logger.warning(f"[INDEX] Removing duplicates before building {collection_name}.{name}")
+            await dedupe()
+            await collection.create_indexes([model])
+        except OperationFailure as e:
+            if e.code != DUPLICATE_KEY_CODE:
+                raise
+            fallback = fallback_index(model)
+            logger.error(
+                f"[INDEX] {collection_name}.{name} still has duplicate keys; "
+                f"building non-unique {fallback.document['name']} until they are removed"
+            )
+            await collection.create_indexes([fallback])
+            return
+    
+    if model.document.get("unique"):
+        fallback_name = fallback_index(model).document["name"]
+        if fallback_name in await collection.index_information():
+            logger.info(f"[INDEX] {collection_name}.{name} is unique now; dropping {fallback_name}")
+            await collection.drop_index(fallback_name)
+
+async def rebuild_index(collection_name: str, model: IndexModel):
+    """Replace an index whose options changed; the old one is only dropped once the new one can be built"""
+    collection = db[collection_name]
+    name = model.document["name"]
+    keys = list(model.document["key"])
+    
+    if model.document.get("unique"):
+        dedupe = UNIQUE_INDEX_DEDUPES.get((collection_name, name))
+        if dedupe is not None:
+            await dedupe()
+        if await has_duplicates(collection, keys):
+            logger.error(f"[INDEX] {collection_name}.{name} has duplicate keys; keeping the old index")
+            return
     
+    old_spec = (await collection.index_information())[name]
+    logger.info(f"[INDEX] Rebuilding {collection_name}.{name} with new options")
+    await collection.drop_index(name)
+    try:
+        await collection.create_indexes([model])
+    except OperationFailure as e:
+        logger.error(f"[INDEX] Could not rebuild {collection_name}.{name}, restoring the old index: {e}")
+        old_keys = old_spec.pop("key")
+        old_spec.pop("v", None)
+        old_spec.pop("ns", None)
+        try:
+            await collection.create_index(old_keys, name=name, **old_spec)
+        except OperationFailure as e:
+            logger.error(f"[INDEX] Could not restore {collection_name}.{name}: {e}")
+
+async def ensure_indexes():
+    """Create every declared index; indexes whose options changed are rebuilt"""
+    for collection_name, models in INDEXES.items():
+        for model in models:
+            name = model.document["name"]
+            try:
+                await create_index(collection_name, model)
+            except OperationFailure as e:
+                if e.code in INDEX_CONFLICT_CODES:
+                    await rebuild_index(collection_name, model)
+                else:
+                    logger.error(f"[INDEX] Could not create {collection_name}.{name}: {e}")
+
+async def index_report() -> dict:
+    """Declared indexes missing (or not unique) on the server, and server indexes never used since restart"""
+    report = {}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        declared = {model.document["name"] for model in models}
+        fallbacks = {fallback_index(model).document["name"] for model in models if model.document.get("unique")}
+        usage = {}
+        unique = set()
+        async for stat in collection.aggregate([{"$indexStats": {}}]):
+            usage[stat["name"]] = stat["accesses"]["ops"]
+            if stat.get("spec", {}).get("unique"):
+                unique.add(stat["name"])
+        
+        report[collection_name] = {
+            "missing": sorted(declared - usage.keys()),
+            # Declared unique but not enforced: duplicates kept the unique build from succeeding
+            "not_unique": sorted(
+                model.document["name"] for model in models
+                if model.document.get("unique") and model.document["name"] not in unique
+                and (model.document["name"] in usage or fallback_index(model).document["name"] in usage)
+            ),
+            "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+            "undeclared": sorted(name for name in usage if name not in declared | fallbacks and name != "_id_"),
+            "ops": usage
+        }
+    return report
+
+# ============================================
+# GEO HELPERS
+# ============================================
+
+def location_to_geojson(location: Optional[dict]) -> Optional[dict]:
+    """Convert a pulpería `location` ({lat, lng}) into a GeoJSON point for the 2dsphere index"""
+    if not location:
+        return None
+    try:
+        lat = float(location["lat"])
+        lng = float(location["lng"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return {"type": "Point", "coordinates": [lng, lat]}
+
+async def backfill_pulperia_geo(batch_size: int = 500):
+    """Derive the `geo` point for pulperías created before proximity search existed"""
+    updated = 0
+    batch = []
+    async for pulperia in db.pulperias.find({"geo": {"$exists": False}}, {"_id": 1, "location": 1}):
+        geo = location_to_geojson(pulperia.get("location"))
+        if not geo:
+            continue
+        batch.append(UpdateOne({"_id": pulperia["_id"]}, {"$set": {"geo": geo}}))
+        if len(batch) >= batch_size:
+            updated += (await db.pulperias.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        updated += (await db.pulperias.bulk_write(batch, ordered=False)).modified_count
+    logger.info(f"[GEO] Backfilled geo point on {updated} pulperías")
+    return updated
+
+def as_utc_datetime(value) -> datetime:
+    """Timestamps are stored as ISO strings or native dates; normalize to an aware UTC datetime"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def utc_now() -> datetime:
+    """Current time at BSON date precision, so a returned document equals what was stored"""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+# Timestamp fields stored as native BSON dates; older documents may still hold ISO strings
+DATETIME_FIELDS = {
+    "users": ["created_at"],
+    "user_sessions": ["created_at", "expires_at"],
+    "pulperias": ["created_at"],
+    "products": ["created_at"],
+    "orders": ["created_at", "updated_at"],
+    "reviews": ["created_at"],
+    "jobs": ["created_at"],
+    "job_applications": ["created_at"],
+    "services": ["created_at"],
+    "messages": ["created_at"],
+    "advertisements": ["created_at", "start_date", "end_date"],
+}
+
+DATETIME_SORT_FIELDS = {field for fields in DATETIME_FIELDS.values() for field in fields}
+
+async def migrate_datetimes(batch_size: int = 1000):
+    """Convert ISO-string timestamps to native dates, streaming each collection in bulk batches"""
+    for collection_name, fields in DATETIME_FIELDS.items():
+        collection = db[collection_name]
+        updated = 0
+        batch = []
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        async for doc in collection.find(query, {field: 1 for field in fields}).batch_size(batch_size):
+            changes = {}
+            for field in fields:
+                if isinstance(doc.get(field), str):
+                    try:
+                        changes[field] = as_utc_datetime(doc[field])
+                    except ValueError:
+                        logger.warning(f"[DATES] Unparseable {collection_name}.{field} on {doc['_id']}: {doc[field]!r}")
+            if not changes:
+                continue
+            batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+            if len(batch) >= batch_size:
+                updated += (await collection.bulk_write(batch, ordered=False)).modified_count
+                batch = []
+        if batch:
+            updated += (await collection.bulk_write(batch, ordered=False)).modified_count
+        logger.info(f"[DATES] Converted timestamps on {updated} {collection_name} documents")
+
+# ============================================
+# REPOSITORY HELPERS
+# ============================================
+
+# Write paths return the document they wrote instead of reading it back
+
+async def insert_document(collection, doc: dict) -> dict:
+    """Insert a document and return it as the API shows it (without Mongo's _id)"""
+    await collection.insert_one(doc)
+    doc.pop("_id", None)
+    return doc
+
+async def update_document(collection, query: dict, update) -> Optional[dict]:
+    """Apply an update and return the document after it (None if nothing matched)"""
+    return await collection.find_one_and_update(
+        query, update, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+
+# ============================================
+# KEYSET PAGINATION
+# ============================================
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 200
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# What encode_cursor can produce: sort-key scalars, with dates tagged as {"$dt": ...}
+CURSOR_VALUE_TYPES = (str, int, float, datetime)
+
+def _cursor_default(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"Cannot encode {type(value).__name__} in cursor")
+
+def _cursor_hook(obj: dict):
+    if "$dt" in obj:
+        return datetime.fromisoformat(obj["$dt"])
+    return obj
+
+def encode_cursor(values: list) -> str:
+    """Opaque cursor holding the sort-key values of the last item on a page"""
+    raw = json.dumps(values, default=_cursor_default, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, expected_length: int) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw, object_hook=_cursor_hook)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(values, list) or len(values) != expected_length:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    # Values go straight into the query: an object here would be read as an operator
+    if not all(value is None or isinstance(value, CURSOR_VALUE_TYPES) and not isinstance(value, bool)
+               for value in values):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return values
+
+def clamp_page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def keyset_filter(sort: list, values: list) -> dict:
+    """Match everything strictly after `values` in `sort` order"""
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        prefix = {prev_field: value for (prev_field, _), value in zip(sort[:i], values[:i])}
+        op = "$gt" if direction == 1 else "$lt"
+        clauses.append({**prefix, field: {op: values[i]}})
+        # Comparisons never cross BSON types, and legacy ISO-string timestamps sort before
+        # every date: past the last date (descending) or string (ascending) come all of the other type
+        if isinstance(values[i], datetime) and op == "$lt":
+            clauses.append({**prefix, field: {"$type": "string"}})
+        elif isinstance(values[i], str) and op == "$gt" and field in DATETIME_SORT_FIELDS:
+            clauses.append({**prefix, field: {"$type": "date"}})
+    return {"$or": clauses}
+
+def with_tiebreak(sort: list, id_field: str) -> list:
+    """Append the unique id so the sort order (and therefore the cursor) is total"""
+    if any(field == id_field for field, _ in sort):
+        return list(sort)
+    return list(sort) + [(id_field, sort[-1][1])]
+
+def apply_cursor(query: dict, sort: list, cursor: Optional[str]) -> dict:
+    if not cursor:
+        return query
+    after = keyset_filter(sort, decode_cursor(cursor, len(sort)))
+    return {"$and": [query, after]} if query else after
+
+def paginate(docs: list, sort: list, limit: int, response: Response) -> list:
+    """Trim a limit+1 fetch to one page and advertise the next cursor, if any"""
+    if len(docs) > limit:
+        last = docs[limit - 1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([last.get(field) for field, _ in sort])
+        del docs[limit:]
+    return docs
+
+async def find_page(collection, query: dict, sort: list, id_field: str, limit: int, cursor: Optional[str], response: Response) -> list:
+    """One page of `collection.find(query)` in `sort` order, continuing after `cursor`"""
+    sort = with_tiebreak(sort, id_field)
+    limit = clamp_page_size(limit)
+    docs = await collection.find(apply_cursor(query, sort, cursor), {"_id": 0}).sort(sort).to_list(limit + 1)
+    return paginate(docs, sort, limit, response)
+
+async def aggregate_page(collection, stages: list, sort: list, id_field: str, limit: int, cursor: Optional[str], response: Response) -> list:
+    """Like find_page, for sort keys computed inside a pipeline (distance, text score)"""
+    sort = with_tiebreak(sort, id_field)
+    limit = clamp_page_size(limit)
+    docs = await collection.aggregate(page_pipeline(stages, sort, limit, cursor)).to_list(limit + 1)
+    return paginate(docs, sort, limit, response)
+
+def page_pipeline(stages: list, sort: list, limit: int, cursor: Optional[str]) -> list:
+    """`stages`, then the keyset match, sort and limit+1 fetch of one page (`sort` already has its tiebreak)"""
+    pipeline = list(stages)
+    if cursor:
+        pipeline.append({"$match": keyset_filter(sort, decode_cursor(cursor, len(sort)))})
+    pipeline += [
+        {"$sort": dict(sort)},
+        {"$limit": limit + 1},
+        {"$project": {"_id": 0}}
+    ]
+    return pipeline
+
+# ============================================
+# SEARCH
+# ============================================
+
+# "regex" (default) keeps substring matching, with the user input escaped, so partial words
+# like "lech" still find "Leche"; "text" is opt-in and uses the collection's text index
+# (ranked, stemmed, accent-insensitive: café == cafe, but whole words only)
+SearchMode = Literal["text", "regex"]
+
+def text_search_terms(search: str) -> str:
+    """Plain words only: drop phrase quotes and negation so users can't alter the query"""
+    words = (word.lstrip("-") for word in search.replace('"', " ").replace("\\", " ").split())
+    return " ".join(word for word in words if word)
+
+def search_filter(search: str, fields: List[str], mode: str) -> dict:
+    if mode == "text":
+        return {"$text": {"$search": text_search_terms(search)}}
+    pattern = re.escape(search)
+    return {"$or": [{field: {"$regex": pattern, "$options": "i"}} for field in fields]}
+
+TEXT_SCORE_SORT = [("score", -1)]
+
+def text_search_stages(query: dict) -> list:
+    return [{"$match": query}, {"$set": {"score": {"$meta": "textScore"}}}]
+
+async def text_search_page(collection, query: dict, id_field: str, limit: int, cursor: Optional[str], response: Response) -> list:
+    """Most relevant first; each result carries its text `score`"""
+    return await aggregate_page(collection, text_search_stages(query), TEXT_SCORE_SORT, id_field, limit, cursor, response)
+
+# ============================================
+# SESSION CACHE
+# ============================================
+
+class SessionCache:
+    """Bounded LRU cache of session_token -> User, so authenticated requests skip MongoDB"""
+    
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Maps session_token to (user, deadline as unix timestamp), oldest first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Maps user_id to the tokens cached for that user
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, token: str) -> Optional[User]:
+        """Return the cached user for a token, or None on miss/expiry"""
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        user, deadline = entry
+        if deadline <= time.time():
+            self._remove(token)
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return user
+    
+    def set(self, token: str, user: User, expires_at: datetime):
+        """Cache a user, never past the session's own expiry"""
+        deadline = min(time.time() + self.ttl_seconds, expires_at.timestamp())
+        if token in self._entries:
+            self._remove(token)
+        
+        self._entries[token] = (user, deadline)
+        self._tokens_by_user.setdefault(user.user_id, set()).add(token)
+        
+        while len(self._entries) > self.max_entries:
+            oldest_token = next(iter(self._entries))
+            self._remove(oldest_token)
+            self.evictions += 1
+    
+    def invalidate(self, token: str):
+        """Drop a single session token"""
+        if token in self._entries:
+            self._remove(token)
+    
+    def invalidate_user(self, user_id: str):
+        """Drop every cached session of a user (e.g. after a profile change)"""
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self._remove(token)
+    
+    def _remove(self, token: str):
+        user, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user.user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.user_id]
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+session_cache = SessionCache(
+    max_entries=int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', '10000')),
+    ttl_seconds=float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+)
+
+SESSION_INVALIDATION_SYNC_SECONDS = float(os.environ.get('SESSION_INVALIDATION_SYNC_SECONDS', '2'))
+
+class SessionInvalidations:
+    """
+    Session-cache invalidations shared between workers. Each one clears this worker's cache
+    at once and is written to MongoDB; every worker applies the others' every
+    SESSION_INVALIDATION_SYNC_SECONDS, so a logout or user_type change stops being served
+    from another worker's cache within that interval rather than the cache TTL.
+    """
+    
+    def __init__(self, cache: SessionCache):
+        self.cache = cache
+        # Anything older is already out of a cache that starts empty
+        self._synced_until = utc_now()
+    
+    async def invalidate_tokens(self, tokens: List[str]):
+        for token in tokens:
+            self.cache.invalidate(token)
+        await self._publish({"tokens": tokens})
+    
+    async def invalidate_user(self, user_id: str):
+        self.cache.invalidate_user(user_id)
+        await self._publish({"user_id": user_id})
+    
+    async def _publish(self, invalidation: dict):
+        now = utc_now()
+        # Kept only as long as a cache entry can live
+        expires_at = now + timedelta(seconds=self.cache.ttl_seconds + SESSION_INVALIDATION_SYNC_SECONDS)
+        await db.session_invalidations.insert_one({**invalidation, "at": now, "expires_at": expires_at})
+    
+    async def sync(self):
+        # Overlap the window a little so invalidations committed out of order aren't missed
+        since = self._synced_until - timedelta(seconds=SESSION_INVALIDATION_SYNC_SECONDS)
+        synced_until = utc_now()
+        async for invalidation in db.session_invalidations.find({"at": {"$gte": since}}, {"_id": 0}):
+            for token in invalidation.get("tokens", ()):
+                self.cache.invalidate(token)
+            if invalidation.get("user_id"):
+                self.cache.invalidate_user(invalidation["user_id"])
+        self._synced_until = synced_until
+
+session_invalidations = SessionInvalidations(session_cache)
+
+class LRUCache:
+    """Bounded key -> value map for lookups that rarely change, least recently used evicted first"""
+    
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key]
+    
+    def set(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+    
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+# pulperia_id -> owner_user_id, so order notifications don't need a pulperia read
+pulperia_owner_cache = LRUCache(max_entries=int(os.environ.get('PULPERIA_OWNER_CACHE_SIZE', '10000')))
+
+async def resolve_pulperia_owner(pulperia_id: str) -> Optional[str]:
+    owner_id = pulperia_owner_cache.get(pulperia_id)
+    if owner_id is None:
+        pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0, "owner_user_id": 1})
+        if not pulperia:
+            return None
+        owner_id = pulperia["owner_user_id"]
+        pulperia_owner_cache.set(pulperia_id, owner_id)
+    return owner_id
+
+# ============================================
+# SIGNED SESSION TOKENS
+# ============================================
+
+SIGNED_TOKEN_PREFIX = "v1."
+REVOCATION_SYNC_SECONDS = float(os.environ.get('REVOCATION_SYNC_SECONDS', '5'))
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+class SessionSigner:
+    """
+    Issues and verifies `v1.<claims>.<hmac-sha256>` tokens. The claims carry what
+    get_current_user needs (user_id, user_type, profile, expiry), so checking a token
+    touches no database; `jti` identifies it for revocation.
+    """
+    
+    def __init__(self, key: str, ttl: timedelta = SESSION_TTL):
+        self._key = key.encode()
+        self.ttl = ttl
+    
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._key, payload.encode(), hashlib.sha256).digest())
+    
+    def issue(self, user: dict) -> tuple:
+        """Return (token, claims) for a user document"""
+        claims = {
+            "user_id": user["user_id"],
+            "user_type": user.get("user_type"),
+            "email": user["email"],
+            "name": user["name"],
+            "picture": user.get("picture"),
+            "created_at": int(as_utc_datetime(user["created_at"]).timestamp()),
+            "exp": int((utc_now() + self.ttl).timestamp()),
+            "jti": secrets.token_hex(8)
+        }
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        return f"{SIGNED_TOKEN_PREFIX}{payload}.{self._sign(payload)}", claims
+    
+    def verify(self, token: str) -> Optional[dict]:
+        """Claims of an authentic, unexpired token; None otherwise"""
+        try:
+            payload, signature = token[len(SIGNED_TOKEN_PREFIX):].split(".")
+            # Bytes, not str: compare_digest raises TypeError on non-ASCII strings
+            if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if claims["exp"] <= time.time():
+            return None
+        return claims
+
+def is_signed_token(token: str) -> bool:
+    return token.startswith(SIGNED_TOKEN_PREFIX)
+
+def claims_to_user(claims: dict) -> User:
+    return User(
+        user_id=claims["user_id"],
+        email=claims["email"],
+        name=claims["name"],
+        picture=claims.get("picture"),
+        user_type=claims.get("user_type"),
+        created_at=datetime.fromtimestamp(claims["created_at"], timezone.utc)
+    )
+
+class RevocationList:
+    """
+    jti -> expiry of logged-out signed tokens. Revocations are written to MongoDB and
+    every worker pulls new ones every REVOCATION_SYNC_SECONDS; entries drop out once
+    the token would have expired anyway, which keeps the list small.
+    """
+    
+    def __init__(self):
+        self._revoked: Dict[str, float] = {}
+        self._synced_until: Optional[datetime] = None
+    
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self._revoked
+    
+    async def revoke(self, claims: dict):
+        self._revoked[claims["jti"]] = claims["exp"]
+        await db.revoked_sessions.update_one(
+            {"jti": claims["jti"]},
+            {"$setOnInsert": {
+                "revoked_at": utc_now(),
+                "expires_at": datetime.fromtimestamp(claims["exp"], timezone.utc)
+            }},
+            upsert=True
+        )
+    
+    async def sync(self):
+        # Overlap the window a little so revocations committed out of order aren't missed
+        query = {"expires_at": {"$gt": utc_now()}}
+        if self._synced_until is not None:
+            query["revoked_at"] = {"$gte": self._synced_until - timedelta(seconds=REVOCATION_SYNC_SECONDS)}
+        synced_until = utc_now()
+        async for revoked in db.revoked_sessions.find(query, {"_id": 0, "jti": 1, "expires_at": 1}):
+            self._revoked[revoked["jti"]] = as_utc_datetime(revoked["expires_at"]).timestamp()
+        self._synced_until = synced_until
+        
+        now = time.time()
+        for jti in [jti for jti, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[jti]
+    
+    def stats(self) -> dict:
+        return {"revoked": len(self._revoked)}
+
+session_signer = SessionSigner(os.environ['SESSION_SIGNING_KEY']) if SESSION_MODE == "signed" else None
+revoked_sessions = RevocationList()
+
+def verify_signed_token(token: str) -> Optional[dict]:
+    """Claims of a signed token that is valid and not logged out, else None"""
+    if session_signer is None:
+        return None
+    claims = session_signer.verify(token)
+    if claims is None or revoked_sessions.is_revoked(claims["jti"]):
+        return None
+    return claims
+
+def extract_session_token(authorization: Optional[str], session_token: Optional[str]) -> Optional[str]:
+    """Cookie wins over the Authorization header, same as the frontend expects"""
     if session_token:
-        token = session_token
-    elif authorization and authorization.startswith("Bearer "):
-        token = authorization.replace("Bearer ", "")
+        return session_token
+    if authorization and authorization.startswith("Bearer "):
+        return authorization.replace("Bearer ", "")
+    return None
+
+async def get_current_user(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    token = extract_session_token(authorization, session_token)
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    return await validate_session_token(token)
+
+# Concurrent cold lookups of the same token share one DB round trip (e.g. a reconnect storm)
+_pending_session_lookups: Dict[str, asyncio.Future] = {}
+
+async def validate_session_token(token: str) -> User:
+    """Resolve a session token to its user: cache first, then one shared DB lookup per token"""
+    if session_signer is not None and is_signed_token(token):
+        claims = verify_signed_token(token)
+        if claims is None:
+            raise HTTPException(status_code=401, detail="Invalid session")
+        return claims_to_user(claims)
+    
+    cached_user = session_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+    
+    pending = _pending_session_lookups.get(token)
+    if pending is None:
+        pending = asyncio.ensure_future(_load_session_user(token))
+        _pending_session_lookups[token] = pending
+        pending.add_done_callback(lambda _: _pending_session_lookups.pop(token, None))
+    return await asyncio.shield(pending)
+
+async def _load_session_user(token: str) -> User:
     session_doc = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
     if not session_doc:
         raise HTTPException(status_code=401, detail="Invalid session")
     
-    expires_at = session_doc["expires_at"]
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    expires_at = as_utc_datetime(session_doc["expires_at"])
     
-    if expires_at < datetime.now(timezone.utc):
+    now = utc_now()
+    if expires_at < now:
         raise HTTPException(status_code=401, detail="Session expired")
     
+    # Sliding expiry, written at most once per half-life rather than on every use
+    if expires_at - now < SESSION_TTL / 2:
+        expires_at = now + SESSION_TTL
+        await db.user_sessions.update_one({"session_token": token}, {"$set": {"expires_at": expires_at}})
+    
     user_doc = await db.users.find_one({"user_id": session_doc["user_id"]}, {"_id": 0})
     if not user_doc:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return User(**user_doc)
+    user = User(**user_doc)
+    session_cache.set(token, user, expires_at)
+    return user
 
-@api_router.post("/auth/session")
-async def create_session(request: SessionRequest, response: Response):
-    logger.info(f"[AUTH] Received session request with session_id: {request.session_id[:10]}...")
+# ============================================
+# AUTH SERVICE CLIENT
+# ============================================
+
+# One pooled client for the whole process: logins reuse warm keep-alive connections
+# instead of paying a TCP + TLS handshake each time.
+AUTH_HTTP_TIMEOUT_SECONDS = float(os.environ.get('AUTH_HTTP_TIMEOUT_SECONDS', '10'))
+AUTH_HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('AUTH_HTTP_CONNECT_TIMEOUT_SECONDS', '3'))
+AUTH_HTTP_MAX_CONNECTIONS = int(os.environ.get('AUTH_HTTP_MAX_CONNECTIONS', '100'))
+AUTH_HTTP_MAX_KEEPALIVE = int(os.environ.get('AUTH_HTTP_MAX_KEEPALIVE', '20'))
+AUTH_HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get('AUTH_HTTP_KEEPALIVE_EXPIRY_SECONDS', '30'))
+# Consecutive upstream failures that open the breaker, and how long it stays open
+AUTH_BREAKER_THRESHOLD = int(os.environ.get('AUTH_BREAKER_THRESHOLD', '5'))
+AUTH_BREAKER_RESET_SECONDS = float(os.environ.get('AUTH_BREAKER_RESET_SECONDS', '30'))
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    AUTH_HTTP2 = os.environ.get('AUTH_HTTP2', '1') == '1'
+except ImportError:
+    AUTH_HTTP2 = False
+
+class CircuitBreaker:
+    """
+    Fails fast once an upstream has failed `threshold` times in a row. After
+    `reset_seconds` one trial call is let through; its outcome closes or re-opens it.
+    """
     
-    async with httpx.AsyncClient() as http_client:
-        try:
-            logger.info(f"[AUTH] Calling Emergent Auth at: {EMERGENT_AUTH_URL}")
-            emergent_response = await http_client.get(
-                EMERGENT_AUTH_URL,
-                headers={"X-Session-ID": request.session_id},
-                timeout=10
+    def __init__(self, threshold: int = AUTH_BREAKER_THRESHOLD, reset_seconds: float = AUTH_BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self.rejected = 0
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+    
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "rejected": self.rejected}
+
+class AuthServiceClient:
+    """Exchanges an OAuth session_id for the user's profile at EMERGENT_AUTH_URL"""
+    
+    def __init__(self, url: str = EMERGENT_AUTH_URL, breaker: Optional[CircuitBreaker] = None):
+        self.url = url
+        self.breaker = breaker or CircuitBreaker()
+        self._http: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+    
+    async def start(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                http2=AUTH_HTTP2,
+                timeout=httpx.Timeout(AUTH_HTTP_TIMEOUT_SECONDS, connect=AUTH_HTTP_CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(
+                    max_connections=AUTH_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=AUTH_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=AUTH_HTTP_KEEPALIVE_EXPIRY_SECONDS
+                )
             )
+    
+    async def stop(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
+    async def fetch_session_data(self, session_id: str) -> dict:
+        if not self.breaker.allow():
+            raise HTTPException(status_code=503, detail="Auth service temporarily unavailable, try again shortly")
+        await self.start()  # No-op once the startup hook has run
+        
+        self.requests += 1
+        try:
+            logger.info(f"[AUTH] Calling Emergent Auth at: {self.url}")
+            emergent_response = await self._http.get(self.url, headers={"X-Session-ID": session_id})
+        except httpx.HTTPError as e:
+            self.breaker.record_failure()
+            logger.error(f"[AUTH] Emergent Auth error: {str(e)}")
+            raise HTTPException(status_code=502, detail=f"Auth service error: {str(e)}")
+        
+        # A rejected session_id is the caller's problem, not an outage
+        if emergent_response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        
+        try:
             emergent_response.raise_for_status()
             auth_data = emergent_response.json()
-            logger.info(f"[AUTH] Emergent Auth successful for email: {auth_data.get('email')}")
-        except Exception as e:
+        except (httpx.HTTPStatusError, ValueError) as e:
             logger.error(f"[AUTH] Emergent Auth error: {str(e)}")
             raise HTTPException(status_code=502, detail=f"Auth service error: {str(e)}")
+        
+        logger.info(f"[AUTH] Emergent Auth successful for email: {auth_data.get('email')}")
+        return auth_data
     
-    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    def stats(self) -> dict:
+        return {"requests": self.requests, "http2": AUTH_HTTP2, "breaker": self.breaker.stats()}
+
+auth_client = AuthServiceClient()
+
+# Mobile clients double-submit /auth/session: duplicates for one session_id share a single
+# exchange, and the result is kept briefly for a retry that arrives just after it finished
+SESSION_EXCHANGE_TTL_SECONDS = float(os.environ.get('SESSION_EXCHANGE_TTL_SECONDS', '10'))
+_session_exchanges: Dict[str, asyncio.Future] = {}
+
+async def exchange_session(session_id: str) -> dict:
+    """Trade an OAuth session_id for {"user", "session_token"}, once per session_id"""
+    pending = _session_exchanges.get(session_id)
+    if pending is None:
+        pending = asyncio.ensure_future(_exchange_session(session_id))
+        _session_exchanges[session_id] = pending
+        
+        def forget(future: asyncio.Future):
+            if _session_exchanges.get(session_id) is future:
+                del _session_exchanges[session_id]
+        
+        def on_done(future: asyncio.Future):
+            if future.cancelled() or future.exception() is not None:
+                forget(future)  # Let the client retry a failed exchange straight away
+            else:
+                asyncio.get_running_loop().call_later(SESSION_EXCHANGE_TTL_SECONDS, forget, future)
+        
+        pending.add_done_callback(on_done)
+    return await asyncio.shield(pending)
+
+async def _exchange_session(session_id: str) -> dict:
+    auth_data = await auth_client.fetch_session_data(session_id)
     session_token = auth_data["session_token"]
     
-    existing_user = await db.users.find_one({"email": auth_data["email"]}, {"_id": 0})
-    
-    if existing_user:
-        user_id = existing_user["user_id"]
-        logger.info(f"[AUTH] Existing user found: {user_id}")
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "name": auth_data["name"],
-                "picture": auth_data["picture"]
-            }}
-        )
-        is_new_user = False
-    else:
-        logger.info(f"[AUTH] Creating new user: {user_id}")
-        user_doc = {
-            "user_id": user_id,
-            "email": auth_data["email"],
-            "name": auth_data["name"],
-            "picture": auth_data["picture"],
-            "user_type": None,  # New users must select their type
-            "location": None,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.users.insert_one(user_doc)
-        is_new_user = True
-    
-    session_doc = {
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.user_sessions.insert_one(session_doc)
+    # Create-or-refresh the user in one round trip; the unique email index settles races
+    new_user_id = f"user_{uuid.uuid4().hex[:12]}"
+    for attempt in range(2):
+        try:
+            user = await db.users.find_one_and_update(
+                {"email": auth_data["email"]},
+                {
+                    "$set": {"name": auth_data["name"], "picture": auth_data["picture"]},
+                    "$setOnInsert": {
+                        "user_id": new_user_id,
+                        "user_type": None,  # New users must select their type
+                        "location": None,
+                        "created_at": utc_now()
+                    }
+                },
+                upsert=True,
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            if attempt:
+                raise
+    user_id = user["user_id"]
+    user["is_new_user"] = user_id == new_user_id
+    logger.info(f"[AUTH] {'Created new' if user['is_new_user'] else 'Existing'} user: {user_id}")
+    
+    # Signed mode keeps no session rows: the token itself carries the session
+    if session_signer is not None:
+        session_token, _ = session_signer.issue(user)
+        logger.info(f"[AUTH] Signed session issued for user: {user_id}")
+        return {"user": user, "session_token": session_token}
+    
+    # Upsert on the token, so a repeated exchange never adds a second session row
+    expires_at = utc_now() + SESSION_TTL
+    await db.user_sessions.update_one(
+        {"session_token": session_token},
+        {
+            # Native date so the TTL index on expires_at can purge it
+            "$set": {"user_id": user_id, "expires_at": expires_at},
+            "$setOnInsert": {"created_at": utc_now()}
+        },
+        upsert=True
+    )
     logger.info(f"[AUTH] Session created for user: {user_id}")
+    await enforce_session_cap(user_id)
     
+    return {"user": user, "session_token": session_token}
+
+async def enforce_session_cap(user_id: str):
+    """Delete a user's sessions beyond MAX_SESSIONS_PER_USER, oldest first"""
+    stale = await db.user_sessions.find(
+        {"user_id": user_id}, {"_id": 0, "session_token": 1}
+    ).sort("created_at", -1).skip(MAX_SESSIONS_PER_USER).to_list(None)
+    if not stale:
+        return
+    tokens = [session["session_token"] for session in stale]
+    await db.user_sessions.delete_many({"session_token": {"$in": tokens}})
+    await session_invalidations.invalidate_tokens(tokens)
+    logger.info(f"[AUTH] Evicted {len(tokens)} old sessions for user: {user_id}")
+
+def set_session_cookie(response: Response, session_token: str):
     response.set_cookie(
         key="session_token",
         value=session_token,
         httponly=True,
         secure=True,
         samesite="none",
-        max_age=7 * 24 * 60 * 60,
+        max_age=int(SESSION_TTL.total_seconds()),
         path="/"
     )
+
+@api_router.post("/auth/session")
+async def create_session(request: SessionRequest, response: Response):
+    logger.info(f"[AUTH] Received session request with session_id: {request.session_id[:10]}...")
+    
+    exchange = await exchange_session(request.session_id)
+    set_session_cookie(response, exchange["session_token"])
     
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    user["is_new_user"] = is_new_user if 'is_new_user' in dir() else False
-    logger.info(f"[AUTH] Returning user data for: {user_id}, user_type: {user.get('user_type')}")
+    user = dict(exchange["user"])
+    logger.info(f"[AUTH] Returning user data for: {user['user_id']}, user_type: {user.get('user_type')}")
     return user
 
 @api_router.get("/auth/me")
-async def get_me(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def get_me(response: Response, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
+    # The app calls this on load; renewing the cookie lets the sliding session outlive the first week
+    if session_token:
+        claims = verify_signed_token(session_token) if is_signed_token(session_token) else None
+        if claims and claims["exp"] - time.time() < SESSION_TTL.total_seconds() / 2:
+            # Signed tokens can't be extended in place: past half-life, hand out a fresh one
+            session_token, _ = session_signer.issue(user.model_dump())
+        set_session_cookie(response, session_token)
     return user
 
 @api_router.post("/auth/logout")
 async def logout(response: Response, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     token = session_token or (authorization.replace("Bearer ", "") if authorization else None)
     
-    if token:
+    if token and session_signer is not None and is_signed_token(token):
+        claims = session_signer.verify(token)
+        if claims:
+            await revoked_sessions.revoke(claims)
+    elif token:
         await db.user_sessions.delete_one({"session_token": token})
+        await session_invalidations.invalidate_tokens([token])
     
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out successfully"}
 
 @api_router.post("/auth/set-user-type")
-async def set_user_type(user_type: Literal["cliente", "pulperia"], authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def set_user_type(user_type: Literal["cliente", "pulperia"], response: Response, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
     
-    await db.users.update_one(
-        {"user_id": user.user_id},
-        {"$set": {"user_type": user_type}}
-    )
+    updated_user = await update_document(db.users, {"user_id": user.user_id}, {"$set": {"user_type": user_type}})
+    await session_invalidations.invalidate_user(user.user_id)
+    
+    # A signed token embeds user_type: swap it for one carrying the new type
+    token = extract_session_token(authorization, session_token)
+    old_claims = verify_signed_token(token) if token and is_signed_token(token) else None
+    if old_claims:
+        new_token, _ = session_signer.issue(updated_user)
+        await revoked_sessions.revoke(old_claims)
+        set_session_cookie(response, new_token)
+        # Bearer clients never see the cookie: they pick the replacement up from the body.
+        # Cookie clients don't get it there, so it stays out of reach of page scripts.
+        if not session_token:
+            updated_user["session_token"] = new_token
     
-    updated_user = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
     return updated_user
 
 @api_router.get("/pulperias")
-async def get_pulperias(lat: Optional[float] = None, lng: Optional[float] = None, search: Optional[str] = None, sort_by: Optional[str] = None):
+async def get_pulperias(response: Response, lat: Optional[float] = None, lng: Optional[float] = None, radius_km: Optional[float] = None, search: Optional[str] = None, search_mode: SearchMode = "regex", sort_by: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    proximity = lat is not None and lng is not None
+    
     query = {}
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"address": {"$regex": search, "$options": "i"}}
-        ]
+        # $text can't be combined with $geoNear, so proximity search matches substrings
+        query = search_filter(search, ["name", "address"], "regex" if proximity else search_mode)
+    
+    # Proximity mode: nearest first, with distance_km on each result
+    if proximity:
+        near = location_to_geojson({"lat": lat, "lng": lng})
+        if not near:
+            raise HTTPException(status_code=400, detail="Coordenadas inválidas")
+        
+        geo_near = {
+            "near": near,
+            "distanceField": "distance_km",
+            "distanceMultiplier": 0.001,  # meters -> km
+            "spherical": True,
+            "query": query
+        }
+        if radius_km is not None:
+            geo_near["maxDistance"] = radius_km * 1000
+        
+        if sort_by == "rating":
+            sort = [("rating", -1), ("distance_km", 1), ("pulperia_id", 1)]
+        else:
+            sort = [("distance_km", 1), ("pulperia_id", 1)]
+            if cursor:
+                # Skip everything closer than the last item before sorting
+                distance_km = decode_cursor(cursor, len(sort))[0]
+                if not isinstance(distance_km, (int, float)):
+                    raise HTTPException(status_code=400, detail="Cursor inválido")
+                geo_near["minDistance"] = max(0, distance_km * 1000 - 1)
+        
+        return await aggregate_page(db.pulperias, [{"$geoNear": geo_near}], sort, "pulperia_id", limit, cursor, response)
+    
+    if search and search_mode == "text" and sort_by != "rating":
+        return await text_search_page(db.pulperias, query, "pulperia_id", limit, cursor, response)
     
-    sort_options = {}
+    sort_options = [("created_at", -1)]
     if sort_by == "rating":
         sort_options = [("rating", -1)]
     
-    pulperias = await db.pulperias.find(query, {"_id": 0}).sort(sort_options if sort_options else [("created_at", -1)]).to_list(100)
-    
-    return pulperias
+    return await find_page(db.pulperias, query, sort_options, "pulperia_id", limit, cursor, response)
 
 @api_router.get("/pulperias/{pulperia_id}")
 async def get_pulperia(pulperia_id: str):
@@ -403,19 +1441,59 @@ async def create_pulperia(pulperia_data: PulperiaCreate, authorization: Optional
         "pulperia_id": pulperia_id,
         "owner_user_id": user.user_id,
         **pulperia_data.model_dump(),
+        "geo": location_to_geojson(pulperia_data.location),
         "rating": 0.0,
         "review_count": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "rating_sum": 0,
+        "created_at": utc_now()
     }
     
-    await db.pulperias.insert_one(pulperia_doc)
+    pulperia = await insert_document(db.pulperias, pulperia_doc)
+    pulperia_owner_cache.set(pulperia_id, user.user_id)
     
-    return await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
+    return pulperia
+
+def rating_increment_pipeline(rating: int) -> list:
+    """Update pipeline adding one review to rating_sum/review_count and recomputing the average"""
+    # Pulperías rated before the counters existed start from their stored average
+    previous_sum = {"$ifNull": ["$rating_sum", {"$multiply": [{"$ifNull": ["$rating", 0]}, {"$ifNull": ["$review_count", 0]}]}]}
+    return [
+        {"$set": {
+            "rating_sum": {"$add": [previous_sum, rating]},
+            "review_count": {"$add": [{"$ifNull": ["$review_count", 0]}, 1]}
+        }},
+        {"$set": {"rating": {"$round": [{"$divide": ["$rating_sum", "$review_count"]}, 1]}}}
+    ]
+
+async def repair_rating_counters():
+    """Drop duplicate reviews, then recompute rating_sum/review_count/rating for every pulpería"""
+    # Reviews written before the unique (pulperia_id, user_id) index: keep each person's first
+    duplicates = await dedupe_collection(db.reviews, ["pulperia_id", "user_id"], {"created_at": 1, "_id": 1})
+    if duplicates:
+        logger.info(f"[RATING] Removed {duplicates} duplicate reviews")
+    
+    await db.reviews.aggregate([
+        {"$group": {"_id": "$pulperia_id", "rating_sum": {"$sum": "$rating"}, "review_count": {"$sum": 1}}},
+        {"$project": {
+            "_id": 0,
+            "pulperia_id": "$_id",
+            "rating_sum": 1,
+            "review_count": 1,
+            "rating": {"$round": [{"$divide": ["$rating_sum", "$review_count"]}, 1]}
+        }},
+        {"$merge": {"into": "pulperias", "on": "pulperia_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]).to_list(None)
+    
+    # Pulperías without any review never received counters from the merge
+    result = await db.pulperias.update_many(
+        {"rating_sum": {"$exists": False}},
+        {"$set": {"rating_sum": 0, "review_count": 0, "rating": 0.0}}
+    )
+    logger.info(f"[RATING] Counters recomputed; {result.modified_count} pulperías without reviews reset")
 
 @api_router.get("/pulperias/{pulperia_id}/reviews")
-async def get_pulperia_reviews(pulperia_id: str):
-    reviews = await db.reviews.find({"pulperia_id": pulperia_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return reviews
+async def get_pulperia_reviews(pulperia_id: str, response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    return await find_page(db.reviews, {"pulperia_id": pulperia_id}, [("created_at", -1)], "review_id", limit, cursor, response)
 
 @api_router.post("/pulperias/{pulperia_id}/reviews")
 async def create_review(pulperia_id: str, review_data: ReviewCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -428,11 +1506,6 @@ async def create_review(pulperia_id: str, review_data: ReviewCreate, authorizati
     if not pulperia:
         raise HTTPException(status_code=404, detail="Pulpería no encontrada")
     
-    # Check if user already reviewed (1 review per person)
-    existing_review = await db.reviews.find_one({"pulperia_id": pulperia_id, "user_id": user.user_id}, {"_id": 0})
-    if existing_review:
-        raise HTTPException(status_code=400, detail="Ya has dejado una review para esta pulpería")
-    
     if review_data.rating < 1 or review_data.rating > 5:
         raise HTTPException(status_code=400, detail="Rating debe estar entre 1 y 5")
     
@@ -448,23 +1521,22 @@ async def create_review(pulperia_id: str, review_data: ReviewCreate, authorizati
         "rating": review_data.rating,
         "comment": review_data.comment,
         "images": images,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.reviews.insert_one(review_doc)
-    
-    # Update pulperia rating
-    all_reviews = await db.reviews.find({"pulperia_id": pulperia_id}, {"_id": 0}).to_list(1000)
-    avg_rating = sum(r["rating"] for r in all_reviews) / len(all_reviews)
+    # The unique (pulperia_id, user_id) index enforces 1 review per person
+    try:
+        review = await insert_document(db.reviews, review_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Ya has dejado una review para esta pulpería")
     
+    # Update pulperia rating from running counters in a single atomic write
     await db.pulperias.update_one(
         {"pulperia_id": pulperia_id},
-        {"$set": {"rating": round(avg_rating, 1), "review_count": len(all_reviews)}}
+        rating_increment_pipeline(review_data.rating)
     )
     
-    return await db.reviews.find_one({"review_id": review_id}, {"_id": 0})
-
-    return await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
+    return review
 
 @api_router.put("/pulperias/{pulperia_id}")
 async def update_pulperia(pulperia_id: str, pulperia_data: PulperiaCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -477,12 +1549,14 @@ async def update_pulperia(pulperia_id: str, pulperia_data: PulperiaCreate, autho
     if pulperia["owner_user_id"] != user.user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso para editar esta pulpería")
     
-    await db.pulperias.update_one(
+    updated_pulperia = await update_document(
+        db.pulperias,
         {"pulperia_id": pulperia_id},
-        {"$set": pulperia_data.model_dump()}
+        {"$set": {**pulperia_data.model_dump(), "geo": location_to_geojson(pulperia_data.location)}}
     )
+    pulperia_owner_cache.invalidate(pulperia_id)
     
-    return await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
+    return updated_pulperia
 
 @api_router.get("/pulperias/{pulperia_id}/products")
 async def get_pulperia_products(pulperia_id: str):
@@ -490,10 +1564,10 @@ async def get_pulperia_products(pulperia_id: str):
     return products
 
 @api_router.get("/products")
-async def search_products(search: Optional[str] = None, category: Optional[str] = None, sort_by: Optional[str] = None):
+async def search_products(response: Response, search: Optional[str] = None, search_mode: SearchMode = "regex", category: Optional[str] = None, sort_by: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
     query = {}
     if search:
-        query["name"] = {"$regex": search, "$options": "i"}
+        query = search_filter(search, ["name"], search_mode)
     if category:
         query["category"] = category
     
@@ -503,7 +1577,10 @@ async def search_products(search: Optional[str] = None, category: Optional[str]
     elif sort_by == "price_desc":
         sort_options = [("price", -1)]
     
-    products = await db.products.find(query, {"_id": 0}).sort(sort_options).to_list(100)
+    if search and search_mode == "text" and sort_by not in ("price_asc", "price_desc"):
+        products = await text_search_page(db.products, query, "product_id", limit, cursor, response)
+    else:
+        products = await find_page(db.products, query, sort_options, "product_id", limit, cursor, response)
     
     # Optimize: Batch fetch pulperia info to avoid N+1 queries
     pulperia_ids = list(set(p["pulperia_id"] for p in products))
@@ -546,12 +1623,10 @@ async def create_product(product_data: ProductCreate, pulperia_id: str, authoriz
         "product_id": product_id,
         "pulperia_id": pulperia_id,
         **product_data.model_dump(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.products.insert_one(product_doc)
-    
-    return await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    return await insert_document(db.products, product_doc)
 
 @api_router.put("/products/{product_id}")
 async def update_product(product_id: str, product_data: ProductCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -565,12 +1640,7 @@ async def update_product(product_id: str, product_data: ProductCreate, authoriza
     if pulperia["owner_user_id"] != user.user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso para editar este producto")
     
-    await db.products.update_one(
-        {"product_id": product_id},
-        {"$set": product_data.model_dump()}
-    )
-    
-    return await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    return await update_document(db.products, {"product_id": product_id}, {"$set": product_data.model_dump()})
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -603,25 +1673,20 @@ async def toggle_product_availability(product_id: str, authorization: Optional[s
     # Toggle availability
     new_available = not product.get("available", True)
     
-    await db.products.update_one(
-        {"product_id": product_id},
-        {"$set": {"available": new_available}}
-    )
-    
-    return await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    return await update_document(db.products, {"product_id": product_id}, {"$set": {"available": new_available}})
 
 @api_router.get("/orders")
-async def get_orders(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def get_orders(response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
     
     if user.user_type == "cliente":
-        orders = await db.orders.find({"customer_user_id": user.user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
+        query = {"customer_user_id": user.user_id}
     else:
         user_pulperias = await db.pulperias.find({"owner_user_id": user.user_id}, {"_id": 0}).to_list(100)
         pulperia_ids = [p["pulperia_id"] for p in user_pulperias]
-        orders = await db.orders.find({"pulperia_id": {"$in": pulperia_ids}}, {"_id": 0}).sort("created_at", -1).to_list(100)
+        query = {"pulperia_id": {"$in": pulperia_ids}}
     
-    return orders
+    return await find_page(db.orders, query, [("created_at", -1)], "order_id", limit, cursor, response)
 
 @api_router.post("/orders")
 async def create_order(order_data: OrderCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -632,57 +1697,241 @@ async def create_order(order_data: OrderCreate, authorization: Optional[str] = H
         "order_id": order_id,
         "customer_user_id": user.user_id,
         **order_data.model_dump(),
+        "owner_user_id": await resolve_pulperia_owner(order_data.pulperia_id),
         "status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.orders.insert_one(order_doc)
+    order = await insert_document(db.orders, order_doc)
     
-    # Get fresh order and broadcast to owner via WebSocket
-    order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    # Broadcast to owner via WebSocket
     await broadcast_order_update(order, "new_order")
     
     return order
 
-@api_router.put("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status_update: OrderStatusUpdate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    user = await get_current_user(authorization, session_token)
+# ============================================
+# DAILY SALES ROLLUP
+# ============================================
+
+# Percent-escaping keeps every product_id distinct ("a.b" and "a_b" stay apart) and reversible;
+# "%" is escaped first so an id can't forge another id's escape
+ROLLUP_KEY_ESCAPES = [("%", "%25"), (".", "%2E"), ("$", "%24")]
+# Orders from before product_id had to be non-empty; no escaped id can equal a lone "%"
+EMPTY_PRODUCT_KEY = "%"
+
+def rollup_product_key(product_id: str) -> str:
+    """product_id is client-supplied; escape it into a usable field name under `products`"""
+    if not product_id:
+        return EMPTY_PRODUCT_KEY
+    for char, escape in ROLLUP_KEY_ESCAPES:
+        product_id = product_id.replace(char, escape)
+    return product_id
+
+def rollup_product_key_expr(field: str) -> dict:
+    """rollup_product_key as an aggregation expression over `field`"""
+    escaped = field
+    for char, escape in ROLLUP_KEY_ESCAPES:
+        escaped = {"$replaceAll": {"input": escaped, "find": {"$literal": char}, "replacement": escape}}
+    return {"$cond": [{"$eq": [field, ""]}, EMPTY_PRODUCT_KEY, escaped]}
+
+async def record_sale(order: dict, sign: int = 1):
+    """Add (sign=1) or remove (sign=-1) a completed order from its pulpería's sales_daily bucket"""
+    day = as_utc_datetime(order["created_at"]).strftime("%Y-%m-%d")
+    increments = {"order_count": sign, "revenue": sign * order.get("total", 0)}
+    names = {}
+    for item in order.get("items", []):
+        key = f"products.{rollup_product_key(item['product_id'])}"
+        increments[f"{key}.quantity"] = increments.get(f"{key}.quantity", 0) + sign * item["quantity"]
+        names[f"{key}.name"] = item["product_name"]
+    
+    await db.sales_daily.update_one(
+        {"pulperia_id": order["pulperia_id"], "day": day},
+        {"$inc": increments, "$set": names},
+        upsert=True
+    )
+
+async def transition_order_status(order: dict, new_status: str) -> Optional[dict]:
+    """
+    Set an order's status and return the updated order (None if it no longer exists).
+    The write is conditioned on the status we last read, so transitions into or out of
+    `completed` are applied to the sales rollup exactly once.
+    """
+    for _ in range(3):
+        updated_order = await db.orders.find_one_and_update(
+            {"order_id": order["order_id"], "status": order["status"]},
+            {"$set": {"status": new_status, "updated_at": utc_now()}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated_order:
+            break
+        # Status changed under us: re-read and apply on top of the latest value
+        order = await db.orders.find_one({"order_id": order["order_id"]}, {"_id": 0})
+        if not order:
+            return None
+    else:
+        raise HTTPException(status_code=409, detail="La orden está siendo actualizada, intenta de nuevo")
     
+    was_completed = order["status"] == "completed"
+    is_completed = new_status == "completed"
+    if was_completed != is_completed:
+        await record_sale(updated_order, 1 if is_completed else -1)
+    
+    return updated_order
+
+ORDER_DAY_EXPR = {"$dateToString": {"format": "%Y-%m-%d", "date": {"$toDate": "$created_at"}}}
+
+def sales_rollup_pipeline(match: dict) -> list:
+    """sales_daily buckets (pulperia_id, day) computed from the completed orders matching `match`"""
+    return [
+        {"$match": {**match, "status": "completed"}},
+        {"$group": {
+            "_id": {"pulperia_id": "$pulperia_id", "day": ORDER_DAY_EXPR},
+            "order_count": {"$sum": 1},
+            "revenue": {"$sum": "$total"},
+            "items": {"$push": "$items"}
+        }},
+        {"$unwind": {"path": "$items", "preserveNullAndEmptyArrays": True}},
+        {"$unwind": {"path": "$items", "preserveNullAndEmptyArrays": True}},
+        {"$group": {
+            "_id": {"pulperia_id": "$_id.pulperia_id", "day": "$_id.day", "product": rollup_product_key_expr("$items.product_id")},
+            "order_count": {"$first": "$order_count"},
+            "revenue": {"$first": "$revenue"},
+            "name": {"$first": "$items.product_name"},
+            "quantity": {"$sum": "$items.quantity"}
+        }},
+        {"$group": {
+            "_id": {"pulperia_id": "$_id.pulperia_id", "day": "$_id.day"},
+            "order_count": {"$first": "$order_count"},
+            "revenue": {"$first": "$revenue"},
+            "products": {"$push": {"k": "$_id.product", "v": {"name": "$name", "quantity": "$quantity"}}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "pulperia_id": "$_id.pulperia_id",
+            "day": "$_id.day",
+            "order_count": 1,
+            "revenue": 1,
+            "products": {"$arrayToObject": {"$filter": {"input": "$products", "cond": {"$ne": ["$$this.k", None]}}}}
+        }}
+    ]
+
+async def rebuild_sales_rollups():
+    """
+    Rebuild sales_daily from every completed order, then swap it in. Sales recorded into the
+    old collection while the rebuild ran are lost with it, so the buckets of every order
+    updated since the start are recomputed from the orders once the new collection is live.
+    """
+    started_at = utc_now()
+    await db.orders.aggregate(sales_rollup_pipeline({}) + [{"$out": "sales_daily_rebuild"}]).to_list(None)
+    
+    await db.sales_daily_rebuild.rename("sales_daily", dropTarget=True)
+    await db.sales_daily.create_indexes(INDEXES["sales_daily"])
+    repaired = await repair_sales_buckets(started_at)
+    await db.maintenance_state.update_one(
+        {"_id": SALES_BACKFILL_MARKER}, {"$set": {"completed_at": utc_now()}}, upsert=True
+    )
+    logger.info(
+        f"[ROLLUP] Rebuilt sales_daily with {await db.sales_daily.estimated_document_count()} buckets "
+        f"({repaired} recomputed for orders updated during the rebuild)"
+    )
+
+async def repair_sales_buckets(since: datetime) -> int:
+    """
+    Recompute, from the orders themselves, the sales_daily buckets of orders updated since `since`.
+    A sale recorded between a bucket's recompute and its write is still lost; rerunning converges.
+    """
+    touched = await db.orders.aggregate([
+        {"$match": {"updated_at": {"$gte": since}}},
+        {"$group": {"_id": {"pulperia_id": "$pulperia_id", "day": ORDER_DAY_EXPR}}}
+    ]).to_list(None)
+    for bucket in touched:
+        key = {"pulperia_id": bucket["_id"]["pulperia_id"], "day": bucket["_id"]["day"]}
+        rollup = await db.orders.aggregate(sales_rollup_pipeline({
+            "pulperia_id": key["pulperia_id"],
+            "$expr": {"$eq": [ORDER_DAY_EXPR, key["day"]]}
+        })).to_list(1)
+        if rollup:
+            await db.sales_daily.replace_one(key, rollup[0], upsert=True)
+        else:
+            # Its last completed order was reopened or cancelled
+            await db.sales_daily.delete_one(key)
+    return len(touched)
+
+# Written by rebuild-sales-rollups. Until the first backfill, sales_daily only holds the
+# sales recorded since rollups shipped, so stats keep reading the orders themselves.
+SALES_BACKFILL_MARKER = "sales_daily_backfill"
+sales_rollups_backfilled = False
+
+async def sales_rollups_ready() -> bool:
+    global sales_rollups_backfilled
+    if not sales_rollups_backfilled:
+        sales_rollups_backfilled = await db.maintenance_state.find_one({"_id": SALES_BACKFILL_MARKER}) is not None
+    return sales_rollups_backfilled
+
+def sales_rollup_stats_pipeline(pulperia_ids: List[str], start_day: str) -> list:
+    """Same facets as order_stats_pipeline, read from the per-day rollups"""
+    return [
+        {"$match": {"pulperia_id": {"$in": pulperia_ids}, "day": {"$gte": start_day}}},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, "total_orders": {"$sum": "$order_count"}, "total_revenue": {"$sum": "$revenue"}}}
+            ],
+            "top_products": [
+                {"$project": {"products": {"$objectToArray": "$products"}}},
+                {"$unwind": "$products"},
+                {"$group": {"_id": "$products.v.name", "quantity": {"$sum": "$products.v.quantity"}}},
+                {"$match": {"quantity": {"$gt": 0}}},
+                {"$sort": {"quantity": -1, "_id": 1}},
+                {"$limit": 5}
+            ],
+            "series": [
+                {"$group": {"_id": "$day", "orders": {"$sum": "$order_count"}, "revenue": {"$sum": "$revenue"}}},
+                {"$sort": {"_id": 1}}
+            ]
+        }}
+    ]
+
+async def change_order_status(user: User, order_id: str, new_status: str) -> dict:
+    """
+    Order-state service shared by the REST and WebSocket paths: checks that the user
+    is the order's customer or its pulpería's owner, applies the transition and
+    notifies both parties. Returns the updated order.
+    """
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Orden no encontrada")
     
-    pulperia = await db.pulperias.find_one({"pulperia_id": order["pulperia_id"]}, {"_id": 0})
-    if pulperia["owner_user_id"] != user.user_id and order["customer_user_id"] != user.user_id:
+    owner_id = order.get("owner_user_id") or await resolve_pulperia_owner(order["pulperia_id"])
+    if owner_id != user.user_id and order["customer_user_id"] != user.user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso para actualizar esta orden")
     
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"status": status_update.status, "updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
-    
-    # Get updated order and broadcast via WebSocket
-    updated_order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    updated_order = await transition_order_status(order, new_status)
+    if not updated_order:
+        raise HTTPException(status_code=404, detail="Orden no encontrada")
     
     # Broadcast update to owner and customer
-    event_type = "cancelled" if status_update.status == "cancelled" else "status_changed"
+    event_type = "cancelled" if new_status == "cancelled" else "status_changed"
     await broadcast_order_update(updated_order, event_type)
     
     return updated_order
 
+@api_router.put("/orders/{order_id}/status")
+async def update_order_status(order_id: str, status_update: OrderStatusUpdate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    return await change_order_status(user, order_id, status_update.status)
+
 @api_router.get("/jobs")
-async def get_jobs(category: Optional[str] = None, search: Optional[str] = None):
+async def get_jobs(response: Response, category: Optional[str] = None, search: Optional[str] = None, search_mode: SearchMode = "regex", limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
     query = {}
     if category:
         query["category"] = category
     if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}}
-        ]
+        query.update(search_filter(search, ["title", "description"], search_mode))
+        if search_mode == "text":
+            return await text_search_page(db.jobs, query, "job_id", limit, cursor, response)
     
-    jobs = await db.jobs.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return jobs
+    return await find_page(db.jobs, query, [("created_at", -1)], "job_id", limit, cursor, response)
 
 @api_router.post("/jobs")
 async def create_job(job_data: JobCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -706,11 +1955,10 @@ async def create_job(job_data: JobCreate, authorization: Optional[str] = Header(
         "pulperia_name": pulperia_name,
         "pulperia_logo": pulperia_logo,
         **{k: v for k, v in job_data.model_dump().items() if k != 'pulperia_id'},
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.jobs.insert_one(job_doc)
-    return await db.jobs.find_one({"job_id": job_id}, {"_id": 0})
+    return await insert_document(db.jobs, job_doc)
 
 @api_router.get("/pulperias/{pulperia_id}/jobs")
 async def get_pulperia_jobs(pulperia_id: str):
@@ -754,11 +2002,10 @@ async def apply_to_job(job_id: str, application_data: JobApplicationCreate, auth
         "applicant_user_id": user.user_id,
         "applicant_name": user.name,
         **application_data.model_dump(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.job_applications.insert_one(application_doc)
-    return await db.job_applications.find_one({"application_id": application_id}, {"_id": 0})
+    return await insert_document(db.job_applications, application_doc)
 
 @api_router.get("/jobs/{job_id}/applications")
 async def get_job_applications(job_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -776,18 +2023,16 @@ async def get_job_applications(job_id: str, authorization: Optional[str] = Heade
     return applications
 
 @api_router.get("/services")
-async def get_services(category: Optional[str] = None, search: Optional[str] = None):
+async def get_services(response: Response, category: Optional[str] = None, search: Optional[str] = None, search_mode: SearchMode = "regex", limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
     query = {}
     if category:
         query["category"] = category
     if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}}
-        ]
+        query.update(search_filter(search, ["title", "description"], search_mode))
+        if search_mode == "text":
+            return await text_search_page(db.services, query, "service_id", limit, cursor, response)
     
-    services = await db.services.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return services
+    return await find_page(db.services, query, [("created_at", -1)], "service_id", limit, cursor, response)
 
 @api_router.post("/services")
 async def create_service(service_data: ServiceCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -799,11 +2044,10 @@ async def create_service(service_data: ServiceCreate, authorization: Optional[st
         "provider_user_id": user.user_id,
         "provider_name": user.name,
         **service_data.model_dump(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.services.insert_one(service_doc)
-    return await db.services.find_one({"service_id": service_id}, {"_id": 0})
+    return await insert_document(db.services, service_doc)
 
 @api_router.delete("/services/{service_id}")
 async def delete_service(service_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -838,8 +2082,38 @@ async def get_completed_orders(authorization: Optional[str] = Header(None), sess
     
     return orders
 
+STATS_BUCKET_FORMATS = {
+    "hour": "%Y-%m-%dT%H:00:00Z",
+    "day": "%Y-%m-%d"
+}
+
+def order_stats_pipeline(match: dict, bucket: str) -> list:
+    """Totals, top products and a bucketed series for the matched orders, in one round trip"""
+    return [
+        {"$match": match},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, "total_orders": {"$sum": 1}, "total_revenue": {"$sum": "$total"}}}
+            ],
+            "top_products": [
+                {"$unwind": "$items"},
+                {"$group": {"_id": "$items.product_name", "quantity": {"$sum": "$items.quantity"}}},
+                {"$sort": {"quantity": -1, "_id": 1}},
+                {"$limit": 5}
+            ],
+            "series": [
+                {"$group": {
+                    "_id": {"$dateToString": {"format": STATS_BUCKET_FORMATS[bucket], "date": {"$toDate": "$created_at"}}},
+                    "orders": {"$sum": 1},
+                    "revenue": {"$sum": "$total"}
+                }},
+                {"$sort": {"_id": 1}}
+            ]
+        }}
+    ]
+
 @api_router.get("/orders/stats")
-async def get_order_stats(period: str = "day", authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def get_order_stats(response: Response, period: str = "day", bucket: Optional[Literal["hour", "day"]] = None, include_orders: bool = False, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
     
     if user.user_type != "pulperia":
@@ -859,38 +2133,44 @@ async def get_order_stats(period: str = "day", authorization: Optional[str] = He
     else:
         start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
     
-    orders = await db.orders.find(
-        {
-            "pulperia_id": {"$in": pulperia_ids},
-            "status": "completed",
-            "created_at": {"$gte": start_date.isoformat()}
-        },
-        {"_id": 0}
-    ).to_list(10000)
-    
-    total_orders = len(orders)
-    total_revenue = sum(order["total"] for order in orders)
-    
-    # Top products
-    product_counts = {}
-    for order in orders:
-        for item in order["items"]:
-            product_name = item["product_name"]
-            if product_name in product_counts:
-                product_counts[product_name] += item["quantity"]
-            else:
-                product_counts[product_name] = item["quantity"]
+    if bucket is None:
+        bucket = "hour" if period == "day" else "day"
     
-    top_products = sorted(product_counts.items(), key=lambda x: x[1], reverse=True)[:5]
+    match = {
+        "pulperia_id": {"$in": pulperia_ids},
+        "status": "completed",
+        "$or": [
+            {"created_at": {"$gte": start_date}},
+            # Orders not yet converted by `migrate-datetimes`
+            {"created_at": {"$type": "string", "$gte": start_date.isoformat()}}
+        ]
+    }
     
-    return {
+    # Week/month dashboards read whole-day rollups instead of rescanning orders
+    if period in ("week", "month") and bucket == "day" and await sales_rollups_ready():
+        pipeline = sales_rollup_stats_pipeline(pulperia_ids, start_date.strftime("%Y-%m-%d"))
+        facets = (await db.sales_daily.aggregate(pipeline).to_list(1))[0]
+    else:
+        facets = (await db.orders.aggregate(order_stats_pipeline(match, bucket)).to_list(1))[0]
+    totals = facets["totals"][0] if facets["totals"] else {"total_orders": 0, "total_revenue": 0}
+    total_orders = totals["total_orders"]
+    total_revenue = totals["total_revenue"]
+    
+    stats = {
         "period": period,
         "total_orders": total_orders,
         "total_revenue": total_revenue,
         "average_order": total_revenue / total_orders if total_orders > 0 else 0,
-        "top_products": [{"name": name, "quantity": qty} for name, qty in top_products],
-        "orders": orders
+        "top_products": [{"name": p["_id"], "quantity": p["quantity"]} for p in facets["top_products"]],
+        "bucket": bucket,
+        "series": [{"bucket": b["_id"], "orders": b["orders"], "revenue": b["revenue"]} for b in facets["series"]]
     }
+    
+    # The raw orders are opt-in and paginated like GET /api/orders
+    if include_orders:
+        stats["orders"] = await find_page(db.orders, match, [("created_at", -1)], "order_id", limit, cursor, response)
+    
+    return stats
 
 # Notifications endpoint for the profile dropdown
 @api_router.get("/notifications")
@@ -944,15 +2224,14 @@ async def get_notifications(authorization: Optional[str] = Header(None), session
     return notifications
 
 @api_router.get("/messages")
-async def get_messages(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def get_messages(response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
     
-    messages = await db.messages.find(
+    return await find_page(
+        db.messages,
         {"$or": [{"from_user_id": user.user_id}, {"to_user_id": user.user_id}]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    
-    return messages
+        [("created_at", -1)], "message_id", limit, cursor, response
+    )
 
 @api_router.post("/messages")
 async def create_message(message_data: MessageCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -963,12 +2242,10 @@ async def create_message(message_data: MessageCreate, authorization: Optional[st
         "message_id": message_id,
         "from_user_id": user.user_id,
         **message_data.model_dump(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.messages.insert_one(message_doc)
-    
-    return await db.messages.find_one({"message_id": message_id}, {"_id": 0})
+    return await insert_document(db.messages, message_doc)
 
 # Advertisement pricing plans
 AD_PLANS = {
@@ -982,29 +2259,71 @@ async def get_ad_plans():
     """Get available advertising plans"""
     return AD_PLANS
 
+class CachedValue:
+    """A single cached value with a deadline, for small hot read-mostly results"""
+    
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._value = None
+        self._deadline = 0.0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self):
+        if self._value is not None and time.time() < self._deadline:
+            self.hits += 1
+            return self._value
+        self.misses += 1
+        return None
+    
+    def set(self, value, expires_at: Optional[datetime] = None):
+        """Cache for ttl_seconds, or until expires_at if that comes first"""
+        deadline = time.time() + self.ttl_seconds
+        if expires_at is not None:
+            deadline = min(deadline, expires_at.timestamp())
+        self._value = value
+        self._deadline = deadline
+    
+    def invalidate(self):
+        self._value = None
+        self._deadline = 0.0
+    
+    def stats(self) -> dict:
+        return {"ttl_seconds": self.ttl_seconds, "hits": self.hits, "misses": self.misses}
+
+# Homepage banner: served from memory, dropped when an ad is activated or the first featured ad ends
+featured_cache = CachedValue(ttl_seconds=float(os.environ.get('FEATURED_CACHE_TTL_SECONDS', '30')))
+
 @api_router.get("/ads/featured")
 async def get_featured_pulperias():
     """Get featured/advertised pulperias"""
-    now = datetime.now(timezone.utc)
-    
-    # Get active ads
-    active_ads = await db.advertisements.find(
-        {"status": "active", "end_date": {"$gte": now.isoformat()}},
-        {"_id": 0}
-    ).sort([("plan", -1), ("created_at", -1)]).to_list(20)
-    
-    # Get pulperia details for each ad
-    featured = []
-    for ad in active_ads:
-        pulperia = await db.pulperias.find_one({"pulperia_id": ad["pulperia_id"]}, {"_id": 0})
-        if pulperia:
-            pulperia["ad_plan"] = ad["plan"]
-            featured.append(pulperia)
+    cached = featured_cache.get()
+    if cached is not None:
+        return cached
+    
+    # Active ads joined with their pulperia in one round trip; expire_ads() retires ended ones
+    featured = await db.advertisements.aggregate([
+        {"$match": {"status": "active"}},
+        {"$sort": {"plan": -1, "created_at": -1}},
+        {"$limit": 20},
+        {"$lookup": {
+            "from": "pulperias",
+            "localField": "pulperia_id",
+            "foreignField": "pulperia_id",
+            "as": "pulperia"
+        }},
+        {"$unwind": "$pulperia"},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$pulperia", {"ad_plan": "$plan", "ad_end_date": "$end_date"}]}}},
+        {"$project": {"_id": 0}}
+    ]).to_list(20)
+    
+    end_dates = [as_utc_datetime(pulperia.pop("ad_end_date")) for pulperia in featured]
+    featured_cache.set(featured, expires_at=min(end_dates) if end_dates else None)
     
     return featured
 
 @api_router.get("/ads/my-ads")
-async def get_my_ads(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def get_my_ads(response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     """Get ads for current user's pulperias"""
     user = await get_current_user(authorization, session_token)
     
@@ -1013,12 +2332,7 @@ async def get_my_ads(authorization: Optional[str] = Header(None), session_token:
     pulperia_ids = [p["pulperia_id"] for p in user_pulperias]
     
     # Get ads for those pulperias
-    ads = await db.advertisements.find(
-        {"pulperia_id": {"$in": pulperia_ids}},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    
-    return ads
+    return await find_page(db.advertisements, {"pulperia_id": {"$in": pulperia_ids}}, [("created_at", -1)], "ad_id", limit, cursor, response)
 
 @api_router.post("/ads/create")
 async def create_advertisement(ad_data: AdvertisementCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -1059,12 +2373,10 @@ async def create_advertisement(ad_data: AdvertisementCreate, authorization: Opti
         "duration_days": plan_info["duration"],
         "start_date": None,
         "end_date": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.advertisements.insert_one(ad_doc)
-    
-    return await db.advertisements.find_one({"ad_id": ad_id}, {"_id": 0})
+    return await insert_document(db.advertisements, ad_doc)
 
 @api_router.put("/ads/{ad_id}/activate")
 async def activate_advertisement(ad_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -1084,16 +2396,54 @@ async def activate_advertisement(ad_id: str, authorization: Optional[str] = Head
     now = datetime.now(timezone.utc)
     end_date = now + timedelta(days=ad["duration_days"])
     
-    await db.advertisements.update_one(
+    activated_ad = await update_document(
+        db.advertisements,
         {"ad_id": ad_id},
         {"$set": {
             "status": "active",
-            "start_date": now.isoformat(),
-            "end_date": end_date.isoformat()
+            "start_date": now,
+            "end_date": end_date
         }}
     )
+    featured_cache.invalidate()
     
-    return await db.advertisements.find_one({"ad_id": ad_id}, {"_id": 0})
+    return activated_ad
+
+# ============================================
+# BACKGROUND TASKS
+# ============================================
+
+AD_SWEEP_INTERVAL_SECONDS = float(os.environ.get('AD_SWEEP_INTERVAL_SECONDS', '60'))
+
+async def expire_ads() -> int:
+    """Move every active ad past its end_date to `expired` in one write"""
+    now = datetime.now(timezone.utc)
+    result = await db.advertisements.update_many(
+        {"status": "active", "$or": [
+            {"end_date": {"$lte": now}},
+            # Ads not yet converted by `migrate-datetimes`
+            {"end_date": {"$type": "string", "$lte": now.isoformat()}}
+        ]},
+        {"$set": {"status": "expired"}}
+    )
+    if result.modified_count:
+        featured_cache.invalidate()
+        logger.info(f"[ADS] Expired {result.modified_count} ads")
+    return result.modified_count
+
+async def run_periodically(name: str, interval_seconds: float, job):
+    """Run `job` forever, every interval_seconds; failures are logged, never fatal"""
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"[{name}] Scheduled run failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+background_tasks: Set[asyncio.Task] = set()
+
+def start_background_task(name: str, interval_seconds: float, job):
+    background_tasks.add(asyncio.create_task(run_periodically(name, interval_seconds, job), name=name))
 
 app.add_middleware(
     CORSMiddleware,
@@ -1101,6 +2451,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 logging.basicConfig(
@@ -1109,21 +2460,487 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ============================================
+# WEBSOCKET FRAMES
+# ============================================
+
+# Messages are serialized once into a text frame and that same frame is written to
+# every socket; orjson is used when installed.
+try:
+    import orjson
+    
+    def encode_frame(message: dict) -> str:
+        return orjson.dumps(message, default=str).decode()
+except ImportError:
+    def _frame_default(value):
+        # Same ISO 8601 form as the REST responses (and orjson)
+        return value.isoformat() if isinstance(value, datetime) else str(value)
+    
+    def encode_frame(message: dict) -> str:
+        return json.dumps(message, default=_frame_default, ensure_ascii=False, separators=(",", ":"))
+
+def add_envelope(body: str, topic: str, seq: int) -> str:
+    """Splice topic/seq into an already serialized (non-empty) message instead of re-encoding it"""
+    return f'{body[:-1]},"topic":{json.dumps(topic)},"seq":{seq}}}'
+
+# ============================================
+# WEBSOCKET BROKERS (fan-out across workers)
+# ============================================
+
+# A broker carries one audience's event, as (topic, seq, frame) entries for each topic
+# the audience is reached through, from whichever worker publishes it to every worker;
+# each worker then delivers it once to each of its own sockets following any of them.
+
+class InMemoryBroker:
+    """Single process: publishing delivers straight to this worker's sockets"""
+    
+    async def start(self, deliver):
+        self._deliver = deliver
+    
+    async def publish(self, entries: List[tuple]):
+        await self._deliver(entries)
+    
+    async def stop(self):
+        pass
+
+class RedisBroker:
+    """Redis pub/sub; `redis_client` can be any redis.asyncio-compatible client (e.g. fakeredis in tests)"""
+    
+    channel = "lapulpe:ws"
+    retry_seconds = 1.0
+    
+    def __init__(self, url: Optional[str] = None, redis_client=None):
+        if redis_client is None:
+            try:
+                import redis.asyncio as redis_asyncio
+            except ImportError:
+                raise RuntimeError("WS_BROKER=redis requires the `redis` package (pip install redis)")
+            redis_client = redis_asyncio.from_url(url)
+        self._redis = redis_client
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+    
+    async def start(self, deliver):
+        self._deliver = deliver
+        await self._subscribe()
+        self._reader = asyncio.create_task(self._read())
+    
+    async def _subscribe(self):
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+    
+    async def _read(self):
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                async for raw in self._pubsub.listen():
+                    if raw.get("type") != "message":
+                        continue
+                    try:
+                        event = json.loads(raw["data"])
+                        await self._deliver([tuple(entry) for entry in event["entries"]])
+                    except Exception as e:
+                        logger.error(f"[WS BROKER] Dropped malformed event: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[WS BROKER] Reading {self.channel} failed, resubscribing: {e}")
+            # The connection dropped (or listen() ended): start over on a fresh pub/sub
+            await self._close_pubsub()
+            await asyncio.sleep(self.retry_seconds)
+    
+    async def _close_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is not None:
+            try:
+                await pubsub.reset()
+            except Exception:
+                pass
+    
+    async def publish(self, entries: List[tuple]):
+        await self._redis.publish(self.channel, json.dumps({"entries": entries}))
+    
+    async def stop(self):
+        if self._reader:
+            self._reader.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self.channel)
+
+class MongoCappedBroker:
+    """No Redis: every worker tails a capped collection that publishers append to"""
+    
+    def __init__(self, database, collection_name: str = "ws_events", size_bytes: int = 16 * 1024 * 1024):
+        self._db = database
+        self._collection_name = collection_name
+        self._size_bytes = size_bytes
+        self._reader: Optional[asyncio.Task] = None
+    
+    async def start(self, deliver):
+        self._deliver = deliver
+        if self._collection_name not in await self._db.list_collection_names():
+            try:
+                await self._db.create_collection(self._collection_name, capped=True, size=self._size_bytes)
+            except OperationFailure:
+                pass  # Another worker created it first
+        self._collection = self._db[self._collection_name]
+        # A tailable cursor dies on an empty collection; make sure there's a starting point
+        await self._collection.insert_one({"type": "worker_started", "at": datetime.now(timezone.utc)})
+        self._reader = asyncio.create_task(self._read())
+    
+    async def _read(self):
+        latest = await self._collection.find_one(sort=[("$natural", -1)])
+        last_id = latest["_id"]
+        while True:
+            cursor = self._collection.find({"_id": {"$gt": last_id}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                while cursor.alive:
+                    async for event in cursor:
+                        last_id = event["_id"]
+                        if "entries" in event:
+                            await self._deliver([tuple(entry) for entry in event["entries"]])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[WS BROKER] Tailing {self._collection_name} failed, retrying: {e}")
+            await asyncio.sleep(1)
+    
+    async def publish(self, entries: List[tuple]):
+        await self._collection.insert_one({"entries": entries})
+    
+    async def stop(self):
+        if self._reader:
+            self._reader.cancel()
+
+def create_ws_broker():
+    """WS_BROKER=memory (default, single worker) | redis (REDIS_URL) | mongo"""
+    backend = os.environ.get('WS_BROKER', 'memory')
+    if backend == "redis":
+        return RedisBroker(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    if backend == "mongo":
+        return MongoCappedBroker(db)
+    return InMemoryBroker()
+
+# ============================================
+# WEBSOCKET REPLAY LOG (resumable streams)
+# ============================================
+
+# Every event published to a topic gets the next per-topic `seq` and is kept in a
+# bounded log, so a client resuming with last_seq=N receives only what it missed.
+# Only topics that were ever subscribed to are logged; events for the rest reach nobody.
+
+WS_REPLAY_BUFFER_SIZE = int(os.environ.get('WS_REPLAY_BUFFER_SIZE', '100'))
+WS_REPLAY_MAX_TOPICS = int(os.environ.get('WS_REPLAY_MAX_TOPICS', '10000'))
+
+class InMemoryEventLog:
+    """Per-topic ring buffers in this process; sequences are only consistent with a single worker"""
+    
+    def __init__(self, buffer_size: int = WS_REPLAY_BUFFER_SIZE, max_topics: int = WS_REPLAY_MAX_TOPICS):
+        self.buffer_size = buffer_size
+        self.max_topics = max_topics
+        # Maps topic to (last seq, deque of (seq, frame)), least recently active first
+        self._topics: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    async def start(self):
+        pass
+    
+    async def track(self, topic: str) -> int:
+        """Keep replay state for a topic from now on; returns its current seq"""
+        last_seq, events = self._topics.pop(topic, (0, None))
+        self._remember(topic, last_seq, events)
+        return last_seq
+    
+    async def append(self, topic: str, body: str, create: bool = False) -> Optional[tuple]:
+        """
+        Assign the next seq to a serialized message, remember the frame; returns (seq, frame),
+        or None without storing anything if the topic isn't tracked and `create` is False
+        """
+        if topic not in self._topics and not create:
+            return None
+        last_seq, events = self._topics.pop(topic, (0, None))
+        seq = last_seq + 1
+        frame = add_envelope(body, topic, seq)
+        self._remember(topic, seq, events).append((seq, frame))
+        return seq, frame
+    
+    def _remember(self, topic: str, seq: int, events: Optional[deque]) -> deque:
+        if events is None:
+            events = deque(maxlen=self.buffer_size)
+        self._topics[topic] = (seq, events)
+        while len(self._topics) > self.max_topics:
+            self._topics.popitem(last=False)
+        return events
+    
+    async def current_seq(self, topic: str) -> int:
+        return self._topics.get(topic, (0, None))[0]
+    
+    async def since(self, topic: str, last_seq: int) -> Optional[List[tuple]]:
+        """Events after last_seq as (seq, frame), or None if some of them are no longer buffered"""
+        current, events = self._topics.get(topic, (0, ()))
+        if last_seq > current:
+            return None  # Log was reset (restart/eviction): the client's position is meaningless
+        missed = [event for event in events if event[0] > last_seq]
+        if len(missed) < current - last_seq:
+            return None
+        return missed
+
+class MongoEventLog:
+    """Sequences from a counter collection and events in a capped collection, shared by all workers"""
+    
+    def __init__(self, database, size_bytes: int = 64 * 1024 * 1024):
+        self._db = database
+        self._size_bytes = size_bytes
+    
+    async def start(self):
+        if "ws_event_log" not in await self._db.list_collection_names():
+            try:
+                await self._db.create_collection("ws_event_log", capped=True, size=self._size_bytes)
+            except OperationFailure:
+                pass  # Another worker created it first
+        await self._db.ws_event_log.create_index([("topic", ASCENDING), ("seq", ASCENDING)])
+    
+    async def track(self, topic: str) -> int:
+        counter = await self._db.ws_sequences.find_one_and_update(
+            {"_id": topic},
+            {"$setOnInsert": {"seq": 0}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"]
+    
+    async def append(self, topic: str, body: str, create: bool = False) -> Optional[tuple]:
+        # Untracked topics match nothing, so nothing is written for them
+        counter = await self._db.ws_sequences.find_one_and_update(
+            {"_id": topic},
+            {"$inc": {"seq": 1}},
+            upsert=create,
+            return_document=ReturnDocument.AFTER
+        )
+        if counter is None:
+            return None
+        seq = counter["seq"]
+        frame = add_envelope(body, topic, seq)
+        await self._db.ws_event_log.insert_one({"topic": topic, "seq": seq, "frame": frame})
+        return seq, frame
+    
+    async def current_seq(self, topic: str) -> int:
+        counter = await self._db.ws_sequences.find_one({"_id": topic})
+        return counter["seq"] if counter else 0
+    
+    async def since(self, topic: str, last_seq: int) -> Optional[List[tuple]]:
+        current = await self.current_seq(topic)
+        if last_seq > current:
+            return None
+        missed = await self._db.ws_event_log.find(
+            {"topic": topic, "seq": {"$gt": last_seq}},
+            {"_id": 0, "seq": 1, "frame": 1}
+        ).sort("seq", 1).to_list(WS_REPLAY_BUFFER_SIZE)
+        # Capped collection rolled over, or more missed than we replay: client must refetch
+        if len(missed) < current - last_seq:
+            return None
+        return [(event["seq"], event["frame"]) for event in missed]
+
+def create_ws_event_log():
+    """
+    WS_REPLAY_STORE=memory (single worker) | mongo (shared by all workers). Defaults to mongo
+    when WS_BROKER spans workers, since per-worker counters would hand out clashing seqs.
+    """
+    cross_worker = os.environ.get('WS_BROKER', 'memory') in ("redis", "mongo")
+    store = os.environ.get('WS_REPLAY_STORE', 'mongo' if cross_worker else 'memory')
+    if store == "mongo":
+        return MongoEventLog(db)
+    if cross_worker:
+        raise RuntimeError("WS_REPLAY_STORE=memory gives every worker its own seq counter; use mongo with WS_BROKER=redis|mongo")
+    return InMemoryEventLog()
+
 # ============================================
 # WEBSOCKET CONNECTION MANAGER FOR REAL-TIME
 # ============================================
 
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '64'))
+WS_SEND_TIMEOUT_SECONDS = float(os.environ.get('WS_SEND_TIMEOUT_SECONDS', '5'))
+WS_CLOSE_SLOW_CONSUMER = 4008
+WS_CLOSE_IDLE = 4000
+# Every socket is pinged once per interval and reaped after the idle timeout without traffic
+WS_HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get('WS_HEARTBEAT_INTERVAL_SECONDS', '30'))
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get('WS_IDLE_TIMEOUT_SECONDS', '90'))
+WS_HEARTBEAT_SLOTS = 30
+WS_PING_FRAME = encode_frame({"type": "ping"})
+WS_MAX_TOPICS_PER_CONNECTION = int(os.environ.get('WS_MAX_TOPICS_PER_CONNECTION', '50'))
+
+# Topics a socket can subscribe to; every socket is subscribed to its own user topic
+def user_topic(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def pulperia_topic(pulperia_id: str) -> str:
+    return f"pulperia:{pulperia_id}"
+
+def order_topic(order_id: str) -> str:
+    return f"order:{order_id}"
+
+async def can_subscribe(user: User, topic: str) -> bool:
+    """Users may follow their own stream, pulperías they own and orders they are party to"""
+    kind, _, key = topic.partition(":")
+    if not key:
+        return False
+    if kind == "user":
+        return key == user.user_id
+    if kind == "pulperia":
+        return await resolve_pulperia_owner(key) == user.user_id
+    if kind == "order":
+        order = await db.orders.find_one(
+            {"order_id": key},
+            {"_id": 0, "customer_user_id": 1, "pulperia_id": 1, "owner_user_id": 1}
+        )
+        if not order:
+            return False
+        if order.get("customer_user_id") == user.user_id:
+            return True
+        owner_id = order.get("owner_user_id") or await resolve_pulperia_owner(order.get("pulperia_id"))
+        return owner_id == user.user_id
+    return False
+
+class ClientConnection:
+    """One socket with its own bounded outbox and writer task, so a slow client only delays itself"""
+    
+    def __init__(self, websocket: WebSocket, user_id: str, manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.manager = manager
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.stopped = False
+        self.writer = asyncio.create_task(self._write())
+        self.topics: Set[str] = set()
+        # While replaying missed events, live events are held back to keep seq order
+        self.replaying = False
+        self.held: List[tuple] = []
+        self.last_seen = time.monotonic()
+        self.wheel_slot: Optional[int] = None
+    
+    def touch(self):
+        """Record inbound traffic from the client"""
+        self.last_seen = time.monotonic()
+    
+    def enqueue(self, frame: str) -> bool:
+        """Queue a serialized frame without waiting; False if the outbox is full"""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+    
+    def deliver(self, entries: List[tuple]) -> bool:
+        """Queue the frame of the first (topic, seq, frame) entry whose topic this socket follows"""
+        if self.replaying:
+            self.held.append(entries)
+            return True
+        for topic, seq, frame in entries:
+            if topic in self.topics:
+                return self.enqueue(frame)
+        return True
+    
+    async def _write(self):
+        # stop() also sets `stopped`: before Python 3.12, wait_for can swallow a cancel that
+        # lands as a send completes, and the writer would then wait on an abandoned queue forever
+        while not self.stopped:
+            frame = await self.queue.get()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(frame), timeout=WS_SEND_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.manager.evict(self, "send timed out")
+                return
+            except Exception as e:
+                self.manager.evict(self, f"send failed: {e}")
+                return
+    
+    def stop(self):
+        self.stopped = True
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+class HeartbeatWheel:
+    """
+    One task pings every socket once per interval: sockets are spread over a ring of
+    slots and each tick handles a single slot, reaping the ones idle past the timeout.
+    """
+    
+    def __init__(self, manager: "ConnectionManager", interval_seconds: float = WS_HEARTBEAT_INTERVAL_SECONDS,
+                 idle_timeout_seconds: float = WS_IDLE_TIMEOUT_SECONDS, slots: int = WS_HEARTBEAT_SLOTS):
+        self.manager = manager
+        self.tick_seconds = interval_seconds / slots
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.slots: List[Set[ClientConnection]] = [set() for _ in range(slots)]
+        self.position = 0
+        self.reaped = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def add(self, client: ClientConnection):
+        # The slot just behind the hand: first ping one full interval from now
+        client.wheel_slot = (self.position - 1) % len(self.slots)
+        self.slots[client.wheel_slot].add(client)
+    
+    def remove(self, client: ClientConnection):
+        if client.wheel_slot is not None:
+            self.slots[client.wheel_slot].discard(client)
+            client.wheel_slot = None
+    
+    def tick(self):
+        slot = self.slots[self.position]
+        self.position = (self.position + 1) % len(self.slots)
+        
+        deadline = time.monotonic() - self.idle_timeout_seconds
+        idle = [client for client in slot if client.last_seen < deadline]
+        for client in idle:
+            self.manager.evict(client, "idle", code=WS_CLOSE_IDLE)
+        self.reaped += len(idle)
+        
+        for client in list(slot):
+            if not client.enqueue(WS_PING_FRAME):
+                self.manager.evict(client, "outbox full")
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"[WS HEARTBEAT] Tick failed: {e}")
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
 class ConnectionManager:
     """Manages WebSocket connections for real-time order updates"""
     
-    def __init__(self):
+    def __init__(self, broker=None, event_log=None):
+        self.broker = broker or InMemoryBroker()
+        self.event_log = event_log or InMemoryEventLog()
         # Maps user_id to set of active WebSocket connections
         self.active_connections: Dict[str, Set[WebSocket]] = {}
         # Track connection count per user
         self.connection_count: Dict[str, int] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
-        """Accept and track a new WebSocket connection"""
+        # Maps each socket to its outbox/writer
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        # Maps topic to the sockets subscribed to it on this worker
+        self.subscriptions: Dict[str, Set[WebSocket]] = {}
+        self.evictions = 0
+        self.heartbeat = HeartbeatWheel(self)
+    
+    async def start(self):
+        await self.event_log.start()
+        await self.broker.start(self.deliver_to_topics)
+        self.heartbeat.start()
+    
+    async def stop(self):
+        self.heartbeat.stop()
+        await self.broker.stop()
+    
+    async def connect(self, websocket: WebSocket, user_id: str) -> int:
+        """Accept and track a new WebSocket connection; returns the seq of the user's topic"""
         await websocket.accept()
         
         if user_id not in self.active_connections:
@@ -1132,12 +2949,24 @@ class ConnectionManager:
         
         self.active_connections[user_id].add(websocket)
         self.connection_count[user_id] += 1
+        client = ClientConnection(websocket, user_id, self)
+        self.clients[websocket] = client
+        self.heartbeat.add(client)
+        self.subscribe(websocket, user_topic(user_id))
         
         logger.info(f"✅ WebSocket connected for user {user_id}. Total connections: {self.connection_count[user_id]}")
+        return await self.event_log.track(user_topic(user_id))
     
     def disconnect(self, websocket: WebSocket, user_id: str):
-        """Remove a WebSocket connection"""
-        if user_id in self.active_connections:
+        """Remove a WebSocket connection (safe to call more than once)"""
+        client = self.clients.pop(websocket, None)
+        if client:
+            client.stop()
+            self.heartbeat.remove(client)
+            for topic in list(client.topics):
+                self._drop_subscription(websocket, topic)
+        
+        if websocket in self.active_connections.get(user_id, ()):
             self.active_connections[user_id].discard(websocket)
             self.connection_count[user_id] = max(0, self.connection_count.get(user_id, 1) - 1)
             
@@ -1147,114 +2976,260 @@ class ConnectionManager:
             
             logger.info(f"❌ WebSocket disconnected for user {user_id}. Remaining: {self.connection_count.get(user_id, 0)}")
     
-    async def send_personal_message(self, message: dict, websocket: WebSocket):
-        """Send message to a specific connection"""
+    def evict(self, client: ClientConnection, reason: str, code: int = WS_CLOSE_SLOW_CONSUMER):
+        """Drop a client that can't keep up (or went silent) and close its socket in the background"""
+        if self.clients.get(client.websocket) is not client:
+            return
+        logger.warning(f"🐢 Evicting WebSocket for user {client.user_id}: {reason}")
+        if code == WS_CLOSE_SLOW_CONSUMER:
+            self.evictions += 1
+        self.disconnect(client.websocket, client.user_id)
+        asyncio.create_task(self._close_quietly(client.websocket, code))
+    
+    async def _close_quietly(self, websocket: WebSocket, code: int):
         try:
-            await websocket.send_json(message)
-        except Exception as e:
-            logger.error(f"Error sending personal message: {e}")
+            await asyncio.wait_for(websocket.close(code=code), timeout=WS_SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass
     
-    async def broadcast_to_user(self, user_id: str, message: dict):
-        """Broadcast message to all connections of a specific user"""
-        if user_id not in self.active_connections:
+    async def send_personal_message(self, message: dict, websocket: WebSocket):
+        """Queue a message for a specific connection"""
+        client = self.clients.get(websocket)
+        if client and not client.enqueue(encode_frame(message)):
+            self.evict(client, "outbox full")
+    
+    def subscribe(self, websocket: WebSocket, topic: str) -> bool:
+        """Add a socket to a topic; False if the socket is gone or already at its topic limit"""
+        client = self.clients.get(websocket)
+        if not client:
+            return False
+        if topic not in client.topics and len(client.topics) >= WS_MAX_TOPICS_PER_CONNECTION:
+            return False
+        client.topics.add(topic)
+        self.subscriptions.setdefault(topic, set()).add(websocket)
+        return True
+    
+    def unsubscribe(self, websocket: WebSocket, topic: str):
+        client = self.clients.get(websocket)
+        if client:
+            client.topics.discard(topic)
+        self._drop_subscription(websocket, topic)
+    
+    def _drop_subscription(self, websocket: WebSocket, topic: str):
+        sockets = self.subscriptions.get(topic)
+        if sockets is None:
             return
-        
-        disconnected = set()
-        for connection in self.active_connections[user_id].copy():
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to user {user_id}: {e}")
-                disconnected.add(connection)
-        
-        # Clean up broken connections
-        for conn in disconnected:
-            self.active_connections[user_id].discard(conn)
+        sockets.discard(websocket)
+        if not sockets:
+            del self.subscriptions[topic]
+    
+    async def broadcast_to_topics(self, topics: List[str], message: dict):
+        """
+        Publish one message to an audience reached through several topics, serializing it once.
+        Topics nobody follows are skipped, and a socket following several of them gets one frame.
+        """
+        body = encode_frame(message)
+        topics = [topic for topic in dict.fromkeys(topics) if topic]
+        appended = await asyncio.gather(*(
+            self.event_log.append(topic, body, create=topic in self.subscriptions) for topic in topics
+        ))
+        entries = [(topic, *entry) for topic, entry in zip(topics, appended) if entry]
+        if entries:
+            await self.broker.publish(entries)
+    
+    async def broadcast_to_user(self, user_id: str, message: dict):
+        """Broadcast message to all connections of a specific user, on every worker"""
+        await self.broadcast_to_topics([user_topic(user_id)], message)
+    
+    async def deliver_to_topics(self, entries: List[tuple]):
+        """Queue one frame on each of this worker's sockets following any of the topics; never waits on a socket"""
+        sockets = set().union(*(self.subscriptions.get(topic, ()) for topic, _, _ in entries))
+        for websocket in sockets:
+            client = self.clients.get(websocket)
+            if client and not client.deliver(entries):
+                self.evict(client, "outbox full")
     
     async def broadcast_to_users(self, user_ids: List[str], message: dict):
         """Broadcast to multiple users (owner and customer)"""
-        for user_id in user_ids:
-            if user_id:
-                await self.broadcast_to_user(user_id, message)
+        await self.broadcast_to_topics([user_topic(user_id) for user_id in user_ids if user_id], message)
+    
+    async def resume(self, websocket: WebSocket, topic: str, last_seq: int) -> bool:
+        """
+        Replay the events of a topic a reconnecting client missed after last_seq, then
+        release any live events that arrived meanwhile. False if the log no longer covers the gap.
+        """
+        client = self.clients.get(websocket)
+        if not client:
+            return False
+        
+        client.replaying = True
+        try:
+            missed = await self.event_log.since(topic, last_seq)
+        finally:
+            client.replaying = False
+        
+        replayed_seq = last_seq
+        for seq, frame in missed or ():
+            if not client.enqueue(frame):
+                self.evict(client, "outbox full")
+                return False
+            replayed_seq = seq
+        
+        held, client.held = client.held, []
+        for entries in held:
+            if any(held_topic == topic and seq <= replayed_seq for held_topic, seq, _ in entries):
+                continue
+            if not client.deliver(entries):
+                self.evict(client, "outbox full")
+                return False
+        
+        return missed is not None
     
     def is_user_connected(self, user_id: str) -> bool:
         """Check if a user has any active connections"""
         return user_id in self.active_connections and len(self.active_connections[user_id]) > 0
+    
+    def stats(self) -> dict:
+        return {
+            "users": len(self.active_connections),
+            "connections": len(self.clients),
+            "topics": len(self.subscriptions),
+            "queued_messages": sum(client.queue.qsize() for client in self.clients.values()),
+            "evictions": self.evictions,
+            "idle_reaped": self.heartbeat.reaped
+        }
 
 # Global connection manager
-ws_manager = ConnectionManager()
+ws_manager = ConnectionManager(create_ws_broker(), create_ws_event_log())
 
 # ============================================
 # WEBSOCKET ENDPOINT
 # ============================================
 
+async def reject_websocket(websocket: WebSocket, code: int, reason: str):
+    """Close with an application code; before accept() the server would answer a bare HTTP 403 instead"""
+    await websocket.accept()
+    await websocket.close(code=code, reason=reason)
+
 @app.websocket("/ws/orders/{user_id}")
 async def websocket_orders_endpoint(websocket: WebSocket, user_id: str):
     """
     WebSocket endpoint for real-time order updates.
     Clients connect with their user_id to receive instant notifications.
+    The session (?token= or the session_token cookie) must belong to that user_id.
     """
-    # Validate user_id by checking if session token is valid
-    token = websocket.query_params.get("token")
+    token = websocket.query_params.get("token") or websocket.cookies.get("session_token")
+    if not token:
+        await reject_websocket(websocket, 4001, "Not authenticated")
+        return
+    
+    # Same cached validator as get_current_user, so reconnect storms mostly hit memory
+    try:
+        user = await validate_session_token(token)
+    except HTTPException as e:
+        await reject_websocket(websocket, 4001, e.detail)
+        return
     
-    # For now, we accept connections if they have a valid user_id format
-    # In production, validate against session tokens
-    if not user_id or len(user_id) < 5:
-        await websocket.close(code=4001, reason="Invalid user_id")
+    if user.user_id != user_id:
+        await reject_websocket(websocket, 4003, "Session does not belong to this user")
         return
     
-    await ws_manager.connect(websocket, user_id)
+    # Reconnecting clients send the last seq they processed to get only what they missed
+    try:
+        last_seq = int(websocket.query_params["last_seq"])
+    except (KeyError, ValueError):
+        last_seq = None
+    
+    user_seq = await ws_manager.connect(websocket, user_id)
     
     try:
         # Send initial connection success message
         await ws_manager.send_personal_message({
             "type": "connected",
             "message": "Conexión establecida. Recibirás actualizaciones en tiempo real.",
-            "user_id": user_id
+            "user_id": user_id,
+            "topic": user_topic(user_id),
+            "seq": user_seq
         }, websocket)
         
-        # Keep connection alive and handle incoming messages
+        if last_seq is not None and not await ws_manager.resume(websocket, user_topic(user_id), last_seq):
+            # Too far behind for the replay log: client falls back to GET /api/orders
+            await ws_manager.send_personal_message({"type": "resync_required", "topic": user_topic(user_id)}, websocket)
+        
+        # Handle incoming messages; the heartbeat wheel pings and reaps idle sockets
+        client = ws_manager.clients.get(websocket)
         while True:
+            data = await websocket.receive_text()
+            if client:
+                client.touch()
             try:
-                data = await asyncio.wait_for(websocket.receive_text(), timeout=60)
                 message = json.loads(data)
-                
-                # Handle ping/pong for keep-alive
-                if message.get("type") == "ping":
-                    await ws_manager.send_personal_message({"type": "pong"}, websocket)
-                
-                # Handle order status update request via WebSocket
-                elif message.get("type") == "update_order_status":
-                    order_id = message.get("order_id")
-                    new_status = message.get("status")
-                    
-                    if order_id and new_status:
-                        # Update in database
-                        result = await db.orders.update_one(
-                            {"order_id": order_id},
-                            {"$set": {"status": new_status, "updated_at": datetime.now(timezone.utc).isoformat()}}
-                        )
-                        
-                        if result.modified_count > 0:
-                            # Get order details for notification
-                            order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
-                            if order:
-                                # Broadcast update to all relevant users
-                                await broadcast_order_update(order, "status_changed")
-                
-            except asyncio.TimeoutError:
-                # Send ping to keep connection alive
-                try:
-                    await ws_manager.send_personal_message({"type": "ping"}, websocket)
-                except:
-                    break
+            except ValueError:
+                continue
+            
+            # Handle ping/pong for keep-alive
+            if message.get("type") == "ping":
+                await ws_manager.send_personal_message({"type": "pong"}, websocket)
+            
+            # Follow a pulperia:{id}, order:{id} or user:{id} topic, optionally resuming after last_seq
+            elif message.get("type") == "subscribe":
+                topic = message.get("topic")
+                if not isinstance(topic, str) or not await can_subscribe(user, topic):
+                    await ws_manager.send_personal_message(
+                        {"type": "subscribe_error", "topic": topic, "detail": "Not authorized"}, websocket)
+                elif not ws_manager.subscribe(websocket, topic):
+                    await ws_manager.send_personal_message(
+                        {"type": "subscribe_error", "topic": topic, "detail": "Too many subscriptions"}, websocket)
+                else:
+                    await ws_manager.send_personal_message({
+                        "type": "subscribed",
+                        "topic": topic,
+                        "seq": await ws_manager.event_log.track(topic)
+                    }, websocket)
+                    topic_last_seq = message.get("last_seq")
+                    if isinstance(topic_last_seq, int) and not await ws_manager.resume(websocket, topic, topic_last_seq):
+                        await ws_manager.send_personal_message({"type": "resync_required", "topic": topic}, websocket)
+            
+            elif message.get("type") == "unsubscribe":
+                topic = message.get("topic")
+                # The user's own topic carries direct notifications and stays subscribed
+                if isinstance(topic, str) and topic != user_topic(user_id):
+                    ws_manager.unsubscribe(websocket, topic)
+                await ws_manager.send_personal_message({"type": "unsubscribed", "topic": topic}, websocket)
+            
+            # Handle order status update request via WebSocket, answered with an ack/nack
+            elif message.get("type") == "update_order_status":
+                await ws_manager.send_personal_message(
+                    await handle_ws_status_update(user, message), websocket)
                     
     except WebSocketDisconnect:
-        ws_manager.disconnect(websocket, user_id)
+        pass
     except Exception as e:
         logger.error(f"WebSocket error for user {user_id}: {e}")
+    finally:
+        # Always release the slot, however the loop ended (no-op if already reaped)
         ws_manager.disconnect(websocket, user_id)
 
+async def handle_ws_status_update(user: User, message: dict) -> dict:
+    """
+    Run a WebSocket status update through the order-state service. The reply echoes the
+    client's request_id; an ack carries the updated order so the client needn't re-fetch.
+    """
+    start = time.perf_counter()
+    reply = {"request_id": message.get("request_id"), "order_id": message.get("order_id")}
+    try:
+        status_update = OrderStatusUpdate(status=message.get("status"))
+        if not isinstance(message.get("order_id"), str):
+            raise HTTPException(status_code=400, detail="order_id es requerido")
+        order = await change_order_status(user, message["order_id"], status_update.status)
+        reply.update({"type": "ack", "order": order})
+    except ValidationError:
+        reply.update({"type": "nack", "status_code": 422, "detail": "Estado inválido"})
+    except HTTPException as e:
+        reply.update({"type": "nack", "status_code": e.status_code, "detail": e.detail})
+    reply["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return reply
+
 # ============================================
 # BROADCAST HELPER FUNCTIONS
 # ============================================
@@ -1264,11 +3239,16 @@ async def broadcast_order_update(order: dict, event_type: str):
     Broadcast order update to owner and customer
     event_type: 'new_order', 'status_changed', 'cancelled'
     """
-    # Get pulperia owner
-    pulperia = await db.pulperias.find_one({"pulperia_id": order.get("pulperia_id")}, {"_id": 0})
-    owner_id = pulperia.get("owner_user_id") if pulperia else None
+    # Owner is denormalized on orders; older orders resolve it through the cache
+    owner_id = order.get("owner_user_id") or await resolve_pulperia_owner(order.get("pulperia_id"))
     customer_id = order.get("customer_user_id")
     
+    # Each audience also reaches whoever follows the pulperia or the order topic, once per socket
+    owner_topics = [user_topic(owner_id) if owner_id else None,
+                    pulperia_topic(order["pulperia_id"]) if order.get("pulperia_id") else None]
+    customer_topics = [user_topic(customer_id) if customer_id else None,
+                       order_topic(order["order_id"]) if order.get("order_id") else None]
+    
     # Send FULL order data for real-time updates (like Papas Pizzeria style)
     full_order_data = {
         "order_id": order.get("order_id"),
@@ -1289,27 +3269,32 @@ async def broadcast_order_update(order: dict, event_type: str):
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
     
+    # Both audiences are published concurrently; delivery only queues on each socket
+    sends = []
+    
     # Send to owner (pulperia) - they need full order details
-    if owner_id:
+    if any(owner_topics):
         owner_notification = {
             **notification,
             "target": "owner",
             "message": get_owner_message(event_type, order),
             "sound": event_type == "new_order"  # Play sound for new orders
         }
-        await ws_manager.broadcast_to_user(owner_id, owner_notification)
+        sends.append(ws_manager.broadcast_to_topics(owner_topics, owner_notification))
         logger.info(f"📤 Sent {event_type} notification to owner {owner_id}")
     
     # Send to customer - they need status updates
-    if customer_id:
+    if any(customer_topics):
         customer_notification = {
             **notification,
             "target": "customer", 
             "message": get_customer_message(event_type, order),
             "sound": event_type in ["ready", "accepted"]  # Sound when order is ready
         }
-        await ws_manager.broadcast_to_user(customer_id, customer_notification)
+        sends.append(ws_manager.broadcast_to_topics(customer_topics, customer_notification))
         logger.info(f"📤 Sent {event_type} notification to customer {customer_id}")
+    
+    await asyncio.gather(*sends)
 
 def get_owner_message(event_type: str, order: dict) -> str:
     """Generate message for pulperia owner"""
@@ -1356,14 +3341,14 @@ async def create_order_realtime(order_data: OrderCreate, authorization: Optional
         "order_id": order_id,
         "customer_user_id": user.user_id,
         **order_data.model_dump(),
+        "owner_user_id": await resolve_pulperia_owner(order_data.pulperia_id),
         "status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
-    await db.orders.insert_one(order_doc)
+    order = await insert_document(db.orders, order_doc)
     
-    # Get fresh order and broadcast to owner
-    order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    # Broadcast to owner
     await broadcast_order_update(order, "new_order")
     
     return order
@@ -1378,9 +3363,77 @@ async def get_ws_status(user_id: str):
         "connection_count": ws_manager.connection_count.get(user_id, 0)
     }
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process counters for scraping (per worker)"""
+    return {
+        "session_cache": session_cache.stats(),
+        "session_mode": SESSION_MODE,
+        "revoked_sessions": revoked_sessions.stats(),
+        "featured_cache": featured_cache.stats(),
+        "pulperia_owner_cache": pulperia_owner_cache.stats(),
+        "auth_service": auth_client.stats(),
+        "websocket": ws_manager.stats()
+    }
+
 # Include the API router AFTER all endpoints are defined
 app.include_router(api_router)
 
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def start_ws_broker():
+    await ws_manager.start()
+
+@app.on_event("startup")
+async def start_auth_client():
+    await auth_client.start()
+
+@app.on_event("startup")
+async def start_scheduler():
+    start_background_task("ADS", AD_SWEEP_INTERVAL_SECONDS, expire_ads)
+    if session_signer is not None:
+        start_background_task("REVOCATIONS", REVOCATION_SYNC_SECONDS, revoked_sessions.sync)
+    else:
+        start_background_task("SESSIONS", SESSION_INVALIDATION_SYNC_SECONDS, session_invalidations.sync)
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await ws_manager.stop()
+    await auth_client.stop()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+
+# ============================================
+# ADMIN COMMANDS: python server.py <command>
+# ============================================
+
+async def print_index_report():
+    print(json.dumps(await index_report(), indent=2))
+
+ADMIN_COMMANDS = {
+    "ensure-indexes": ensure_indexes,
+    "index-report": print_index_report,
+    "backfill-geo": backfill_pulperia_geo,
+    "repair-ratings": repair_rating_counters,
+    "rebuild-sales-rollups": rebuild_sales_rollups,
+    "expire-ads": expire_ads,
+    "migrate-datetimes": migrate_datetimes,
+}
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) != 2 or sys.argv[1] not in ADMIN_COMMANDS:
+        print(f"Usage: python server.py <{'|'.join(ADMIN_COMMANDS)}>")
+        sys.exit(1)
+    
+    asyncio.run(ADMIN_COMMANDS[sys.argv[1]]())
\ No newline at end of file
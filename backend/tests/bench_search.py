@@ -0,0 +1,146 @@
+"""
+Benchmark: text-index search vs. escaped regex search on a 100k-product fixture,
+timed through the same paging helpers GET /api/products runs.
+
+Runs against the MongoDB in MONGO_URL using a throwaway database:
+    cd backend && python tests/bench_search.py [--products 100000] [--keep]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from server import (
+    DEFAULT_PAGE_SIZE, INDEXES, TEXT_SCORE_SORT, Response, find_page, page_pipeline,
+    search_filter, text_search_page, text_search_stages, with_tiebreak
+)
+
+BENCH_DB = "lapulpe_bench_search"
+QUERIES = ["cafe", "café", "azucar", "leche entera", "jamon", "pan"]
+RUNS = 20
+
+PRODUCT_WORDS = [
+    "Café", "Azúcar", "Leche", "Entera", "Pan", "Dulce", "Jamón", "Queso", "Frijoles", "Arroz",
+    "Plátano", "Tortillas", "Mantequilla", "Crema", "Huevos", "Gaseosa", "Jugo", "Galletas", "Sal", "Aceite"
+]
+BRANDS = ["Sula", "Dos Pinos", "Maseca", "Pepsi", "Coca-Cola", "Bimbo", "Lido", "Yummies", "Del Campo"]
+SIZES = ["250g", "500g", "1kg", "355ml", "1L", "2L", "12 unidades"]
+
+
+def execution_stats(explain):
+    """(docs examined, docs returned) from find or aggregate explain output, wherever the server nests it"""
+    if isinstance(explain, dict):
+        if "executionStats" in explain:
+            stats = explain["executionStats"]
+            return stats.get("totalDocsExamined"), stats.get("nReturned")
+        children = explain.values()
+    elif isinstance(explain, list):
+        children = explain
+    else:
+        return None
+    for child in children:
+        found = execution_stats(child)
+        if found:
+            return found
+    return None
+
+
+class SearchBenchmark:
+    def __init__(self, products=100000):
+        self.client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        self.db = self.client[BENCH_DB]
+        self.products = products
+
+    async def setup_fixture(self):
+        """Insert the product fixture and the declared product indexes"""
+        print(f"\n=== INSERTING {self.products} PRODUCTS ===")
+        await self.db.products.drop()
+        rng = random.Random(42)
+        batch = []
+        for i in range(self.products):
+            words = rng.sample(PRODUCT_WORDS, 2)
+            batch.append({
+                "product_id": f"product_{i:012d}",
+                "pulperia_id": f"pulperia_{i % 500:012d}",
+                "name": f"{words[0]} {words[1]} {rng.choice(BRANDS)} {rng.choice(SIZES)}",
+                "description": f"{rng.choice(PRODUCT_WORDS)} de la casa",
+                "price": round(rng.uniform(5, 300), 2),
+                "created_at": f"2025-01-01T00:00:{i % 60:02d}+00:00"
+            })
+            if len(batch) == 5000:
+                await self.db.products.insert_many(batch)
+                batch = []
+        if batch:
+            await self.db.products.insert_many(batch)
+        await self.db.products.create_indexes(INDEXES["products"])
+        print("✅ Fixture ready")
+
+    async def time_page(self, fetch_page):
+        start = time.perf_counter()
+        for _ in range(RUNS):
+            await fetch_page()
+        return (time.perf_counter() - start) * 1000 / RUNS
+
+    async def time_text_search(self, query):
+        """The endpoint's path: text_search_page's aggregate ($match, $set score, $sort, $limit)"""
+        elapsed_ms = await self.time_page(
+            lambda: text_search_page(self.db.products, query, "product_id", DEFAULT_PAGE_SIZE, None, Response())
+        )
+        sort = with_tiebreak(TEXT_SCORE_SORT, "product_id")
+        explain = await self.db.command({
+            "explain": {
+                "aggregate": "products",
+                "pipeline": page_pipeline(text_search_stages(query), sort, DEFAULT_PAGE_SIZE, None),
+                "cursor": {}
+            },
+            "verbosity": "executionStats"
+        })
+        return (elapsed_ms, *(execution_stats(explain) or (None, None)))
+
+    async def time_regex_search(self, query):
+        """The endpoint's path for search_mode=regex: find_page, newest first"""
+        sort = [("created_at", -1)]
+        elapsed_ms = await self.time_page(
+            lambda: find_page(self.db.products, query, sort, "product_id", DEFAULT_PAGE_SIZE, None, Response())
+        )
+        explain = await self.db.products.find(query).sort(with_tiebreak(sort, "product_id")).limit(DEFAULT_PAGE_SIZE + 1).explain()
+        return (elapsed_ms, *(execution_stats(explain) or (None, None)))
+
+    async def run(self):
+        await self.setup_fixture()
+        print(f"\n=== SEARCH ({RUNS} runs per query, first page of {DEFAULT_PAGE_SIZE}) ===")
+        print(f"{'query':<14} {'mode':<6} {'ms/query':>9} {'examined':>9} {'returned':>9}")
+        for search in QUERIES:
+            for mode in ("regex", "text"):
+                query = search_filter(search, ["name"], mode)
+                timer = self.time_text_search if mode == "text" else self.time_regex_search
+                elapsed_ms, examined, returned = await timer(query)
+                print(f"{search:<14} {mode:<6} {elapsed_ms:>9.2f} {examined!s:>9} {returned!s:>9}")
+
+    async def cleanup(self):
+        await self.client.drop_database(BENCH_DB)
+        print("\n🧹 Benchmark database dropped")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--keep", action="store_true", help="keep the fixture database")
+    args = parser.parse_args()
+
+    benchmark = SearchBenchmark(products=args.products)
+    try:
+        await benchmark.run()
+    finally:
+        if not args.keep:
+            await benchmark.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,278 @@
+"""
+Shared test setup: import path and environment for `server`, an in-memory stand-in
+for the Motor database that counts every operation it receives, and a fake socket.
+"""
+import asyncio
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from pymongo.errors import OperationFailure
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "lapulpe_test")
+
+def bson_rank(value):
+    """BSON comparison order of the types the tests use; comparisons never cross types"""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, datetime):
+        return 9
+    return 3
+
+
+def comparable(value, bound):
+    return value is not None and bson_rank(value) == bson_rank(bound)
+
+
+COMPARISONS = {
+    "$gt": lambda value, bound: comparable(value, bound) and value > bound,
+    "$gte": lambda value, bound: comparable(value, bound) and value >= bound,
+    "$lt": lambda value, bound: comparable(value, bound) and value < bound,
+    "$lte": lambda value, bound: comparable(value, bound) and value <= bound,
+    "$in": lambda value, options: value in options,
+    "$type": lambda value, name: bson_rank(value) == {"string": 2, "date": 9}[name],
+}
+
+
+def matches(doc, query):
+    """Equality, $and/$or and the comparison operators above; anything else is a test bug"""
+    for key, expected in query.items():
+        if key in ("$and", "$or"):
+            found = (matches(doc, clause) for clause in expected)
+            if not (all(found) if key == "$and" else any(found)):
+                return False
+        elif isinstance(expected, dict) and any(op.startswith("$") for op in expected):
+            for op, bound in expected.items():
+                if op not in COMPARISONS:
+                    raise NotImplementedError(f"FakeCollection does not support {op}")
+                if not COMPARISONS[op](doc.get(key), bound):
+                    return False
+        elif doc.get(key) != expected:
+            return False
+    return True
+
+
+def project(doc, projection):
+    doc = dict(doc)
+    if projection and projection.get("_id") == 0:
+        doc.pop("_id", None)
+    return doc
+
+
+def apply_update(doc, update, inserting):
+    if isinstance(update, list):
+        return  # Update pipelines are only counted
+    if inserting:
+        doc.update(update.get("$setOnInsert", {}))
+    doc.update(update.get("$set", {}))
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        """sort("field", direction) or sort([(field, direction), ...]), in BSON type order"""
+        for field, field_direction in reversed([(key, direction)] if isinstance(key, str) else key):
+            self.docs.sort(key=lambda doc: (bson_rank(doc.get(field)), doc.get(field)), reverse=field_direction < 0)
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    async def to_list(self, length):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+def group_key(doc, spec):
+    return tuple(sorted((key, doc.get(path[1:])) for key, path in spec.items()))
+
+
+def run_pipeline(docs, pipeline):
+    """The aggregation stages the index maintenance code uses: $sort, $group, $match, $limit"""
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == "$sort":
+            for key, direction in reversed(list(arg.items())):
+                docs = sorted(docs, key=lambda doc: (bson_rank(doc.get(key)), doc.get(key)), reverse=direction < 0)
+        elif op == "$group":
+            groups = {}
+            for doc in docs:
+                key = group_key(doc, arg["_id"])
+                group = groups.setdefault(key, {"_id": dict(key)})
+                for field, (acc, value) in ((f, *a.items()) for f, a in arg.items() if f != "_id"):
+                    item = doc.get(value[1:]) if isinstance(value, str) else value
+                    if acc == "$push":
+                        group.setdefault(field, []).append(item)
+                    elif acc == "$sum":
+                        group[field] = group.get(field, 0) + item
+                    else:
+                        raise NotImplementedError(f"FakeCollection does not support {acc}")
+            docs = list(groups.values())
+        elif op == "$match":
+            docs = [doc for doc in docs if matches(doc, arg)]
+        elif op == "$limit":
+            docs = docs[:arg]
+        else:
+            raise NotImplementedError(f"FakeCollection does not support {op}")
+    return docs
+
+
+class FakeCollection:
+    """In-memory collection recording `<collection>.<operation>` counts in a shared Counter"""
+
+    def __init__(self, name, ops, docs=(), latency=0.0):
+        self.name = name
+        self.ops = ops
+        self.latency = latency
+        self.docs = [dict(doc) for doc in docs]
+        self._next_id = len(self.docs)
+        # Index name -> {"key": [(field, direction)], "unique": bool}
+        self.indexes = {}
+
+    async def _op(self, op):
+        self.ops[f"{self.name}.{op}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _matching(self, query):
+        return [doc for doc in self.docs if matches(doc, query)]
+
+    def _upsert(self, query, update, upsert):
+        found = self._matching(query)
+        if found:
+            apply_update(found[0], update, inserting=False)
+            return found[0]
+        if not upsert:
+            return None
+        self._next_id += 1
+        doc = {"_id": self._next_id, **{k: v for k, v in query.items() if not isinstance(v, dict)}}
+        apply_update(doc, update, inserting=True)
+        self.docs.append(doc)
+        return doc
+
+    async def find_one(self, query, projection=None):
+        await self._op("find_one")
+        found = self._matching(query)
+        return project(found[0], projection) if found else None
+
+    def find(self, query, projection=None):
+        self.ops[f"{self.name}.find"] += 1
+        return FakeCursor([project(doc, projection) for doc in self._matching(query)])
+
+    async def insert_one(self, doc):
+        await self._op("insert_one")
+        self._next_id += 1
+        doc["_id"] = self._next_id
+        self.docs.append(dict(doc))
+
+    async def update_one(self, query, update, upsert=False):
+        await self._op("update_one")
+        self._upsert(query, update, upsert)
+
+    async def find_one_and_update(self, query, update, upsert=False, projection=None, return_document=None):
+        await self._op("find_one_and_update")
+        doc = self._upsert(query, update, upsert)
+        return project(doc, projection) if doc else None
+
+    async def delete_one(self, query):
+        await self._op("delete_one")
+        found = self._matching(query)
+        if found:
+            self.docs.remove(found[0])
+
+    async def delete_many(self, query):
+        await self._op("delete_many")
+        kept = [doc for doc in self.docs if not matches(doc, query)]
+        deleted, self.docs = len(self.docs) - len(kept), kept
+        return type("DeleteResult", (), {"deleted_count": deleted})()
+
+    def aggregate(self, pipeline, **kwargs):
+        self.ops[f"{self.name}.aggregate"] += 1
+        if pipeline[0] == {"$indexStats": {}}:
+            stats = [{"name": name, "accesses": {"ops": 0}, "spec": {"key": dict(spec["key"]), "unique": spec["unique"]}}
+                     for name, spec in self.indexes.items()]
+            return FakeCursor(run_pipeline(stats, pipeline[1:]))
+        return FakeCursor(run_pipeline([dict(doc) for doc in self.docs], pipeline))
+
+    async def create_indexes(self, models):
+        await self._op("create_indexes")
+        for model in models:
+            spec = {"key": list(model.document["key"].items()), "unique": model.document.get("unique", False)}
+            name = model.document["name"]
+            if name in self.indexes and self.indexes[name] != spec:
+                raise OperationFailure(f"Index {name} exists with different options", code=85)
+            if spec["unique"]:
+                keys = [(field, f"${field}") for field, _ in spec["key"]]
+                if len({group_key(doc, dict(keys)) for doc in self.docs}) < len(self.docs):
+                    raise OperationFailure(f"E11000 duplicate key building {name}", code=11000)
+            self.indexes[name] = spec
+
+    async def create_index(self, keys, name, unique=False, **options):
+        await self._op("create_index")
+        self.indexes[name] = {"key": list(keys), "unique": unique}
+
+    async def index_information(self):
+        return {name: {"key": list(spec["key"]), "v": 2, **({"unique": True} if spec["unique"] else {})}
+                for name, spec in self.indexes.items()}
+
+    async def drop_index(self, name):
+        await self._op("drop_index")
+        del self.indexes[name]
+
+
+class FakeDatabase:
+    """`db.<name>` / `db[<name>]` return FakeCollections that share one operation Counter"""
+
+    def __init__(self, fixtures=None, latency=0.0):
+        self.ops = Counter()
+        self.latency = latency
+        self.collections = {
+            name: FakeCollection(name, self.ops, docs, latency) for name, docs in (fixtures or {}).items()
+        }
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name, self.ops, latency=self.latency)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+class FakeWebSocket:
+    """Records the frames sent and the close code; with `stalled`, send_text never completes"""
+
+    def __init__(self, stalled=False):
+        self.frames = []
+        self.stalled = stalled
+        self.close_codes = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame):
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.frames.append(frame)
+
+    async def close(self, code=1000, reason=None):
+        self.close_codes.append(code)
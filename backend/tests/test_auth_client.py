@@ -0,0 +1,226 @@
+"""
+Auth service client against a local stub of EMERGENT_AUTH_URL: connection reuse
+across logins and the circuit breaker. No external network needed:
+    cd backend && python -m pytest -q tests/test_auth_client.py
+"""
+import asyncio
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import server
+from conftest import FakeDatabase
+
+LOGINS = 20
+DOUBLE_SUBMITS = 10
+
+
+class StubAuthServer:
+    """Serves session-data like the Emergent auth service; `status` switches it to error replies"""
+
+    def __init__(self):
+        self.status = 200
+        self.connections = 0
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                stub.connections += 1
+                super().setup()
+
+            def do_GET(self):
+                stub.requests += 1
+                session_id = self.headers.get("X-Session-ID", "")
+                body = json.dumps({
+                    "id": f"oauth_{session_id}",
+                    "email": f"{session_id}@example.com",
+                    "name": "Stub User",
+                    "picture": None,
+                    "session_token": f"token_{session_id}"
+                } if stub.status == 200 else {"detail": "stub error"}).encode()
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/auth/v1/env/oauth/session-data"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def run_with_client(stub, breaker, scenario):
+    async def run():
+        auth_client = server.AuthServiceClient(stub.url, breaker)
+        await auth_client.start()
+        try:
+            return await scenario(auth_client)
+        finally:
+            await auth_client.stop()
+    return asyncio.run(run())
+
+
+def test_logins_reuse_one_pooled_connection():
+    with StubAuthServer() as stub:
+        async def logins(auth_client):
+            start = time.perf_counter()
+            results = [await auth_client.fetch_session_data(f"session{i}") for i in range(LOGINS)]
+            return results, time.perf_counter() - start
+
+        results, elapsed = run_with_client(stub, server.CircuitBreaker(), logins)
+
+    print(f"\n🔐 {LOGINS} logins in {elapsed * 1000:.1f} ms over {stub.connections} connection(s)")
+    assert [r["session_token"] for r in results] == [f"token_session{i}" for i in range(LOGINS)]
+    assert stub.requests == LOGINS
+    assert stub.connections == 1
+
+
+def test_breaker_fails_fast_then_recovers():
+    breaker = server.CircuitBreaker(threshold=3, reset_seconds=0.05)
+    with StubAuthServer() as stub:
+        stub.status = 500
+
+        async def outage_then_recovery(auth_client):
+            codes = []
+            for _ in range(5):
+                with pytest.raises(server.HTTPException) as exc:
+                    await auth_client.fetch_session_data("session")
+                codes.append(exc.value.status_code)
+            upstream_calls = stub.requests
+            stub.status = 200
+            await asyncio.sleep(0.06)
+            recovered = await auth_client.fetch_session_data("session")
+            return codes, upstream_calls, recovered
+
+        codes, upstream_calls, recovered = run_with_client(stub, breaker, outage_then_recovery)
+
+    assert codes == [502, 502, 502, 503, 503]
+    assert upstream_calls == 3
+    assert recovered["session_token"] == "token_session"
+    assert breaker.state == "closed"
+
+
+def test_rejected_session_id_does_not_open_breaker():
+    breaker = server.CircuitBreaker(threshold=2, reset_seconds=60)
+    with StubAuthServer() as stub:
+        stub.status = 401
+
+        async def bad_sessions(auth_client):
+            for _ in range(5):
+                with pytest.raises(server.HTTPException):
+                    await auth_client.fetch_session_data("expired")
+
+        run_with_client(stub, breaker, bad_sessions)
+
+    assert stub.requests == 5
+    assert breaker.state == "closed"
+
+
+def fake_auth_db(monkeypatch, fixtures=None):
+    fake_db = FakeDatabase(fixtures)
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "_session_exchanges", {})
+    return fake_db
+
+
+def test_double_submitted_session_id_is_exchanged_once(monkeypatch):
+    fake_db = fake_auth_db(monkeypatch)
+
+    with StubAuthServer() as stub:
+        async def double_submit():
+            auth_client = server.AuthServiceClient(stub.url)
+            monkeypatch.setattr(server, "auth_client", auth_client)
+            try:
+                concurrent = await asyncio.gather(*(
+                    server.create_session(server.SessionRequest(session_id="tap"), server.Response())
+                    for _ in range(DOUBLE_SUBMITS)
+                ))
+                late_retry = await server.create_session(server.SessionRequest(session_id="tap"), server.Response())
+                return concurrent + [late_retry]
+            finally:
+                await auth_client.stop()
+
+        users = asyncio.run(double_submit())
+
+    assert stub.requests == 1
+    assert dict(fake_db.ops) == {"users.find_one_and_update": 1, "user_sessions.update_one": 1, "user_sessions.find": 1}
+    assert len(fake_db.user_sessions.docs) == 1
+    assert all(user == users[0] and user["is_new_user"] for user in users)
+
+
+def test_sessions_beyond_cap_evict_oldest(monkeypatch):
+    fake_db = fake_auth_db(monkeypatch)
+    monkeypatch.setattr(server, "MAX_SESSIONS_PER_USER", 3)
+    monkeypatch.setattr(server, "session_cache", server.SessionCache())
+
+    async def logins():
+        for i in range(5):
+            fake_db.user_sessions.docs.append({
+                "session_token": f"token_{i}", "user_id": "user_1",
+                "created_at": server.utc_now() + timedelta(seconds=i)
+            })
+            await server.enforce_session_cap("user_1")
+
+    asyncio.run(logins())
+
+    assert sorted(doc["session_token"] for doc in fake_db.user_sessions.docs) == ["token_2", "token_3", "token_4"]
+
+
+@pytest.mark.parametrize("remaining, refreshed", [(timedelta(days=6), False), (timedelta(days=2), True)])
+def test_session_expiry_slides_only_past_half_life(monkeypatch, remaining, refreshed):
+    fake_db = fake_auth_db(monkeypatch, {
+        "user_sessions": [{"session_token": "token", "user_id": "user_1", "expires_at": server.utc_now() + remaining}],
+        "users": [{"user_id": "user_1", "email": "user1@example.com", "name": "User", "created_at": server.utc_now()}],
+    })
+    monkeypatch.setattr(server, "session_cache", server.SessionCache())
+
+    user = asyncio.run(server._load_session_user("token"))
+
+    assert user.user_id == "user_1"
+    assert fake_db.ops["user_sessions.update_one"] == (1 if refreshed else 0)
+    if refreshed:
+        assert fake_db.user_sessions.docs[0]["expires_at"] > server.utc_now() + timedelta(days=6)
+
+
+def test_invalidation_reaches_other_workers_caches(monkeypatch):
+    fake_db = fake_auth_db(monkeypatch, {
+        "user_sessions": [{"session_token": "token", "user_id": "user_1", "expires_at": server.utc_now() + timedelta(days=7)}],
+        "users": [{"user_id": "user_1", "email": "user1@example.com", "name": "User", "created_at": server.utc_now()}],
+    })
+    this_worker, other_worker = server.SessionCache(), server.SessionCache()
+    this_feed, other_feed = server.SessionInvalidations(this_worker), server.SessionInvalidations(other_worker)
+
+    async def pick_type_then_sync():
+        for cache in (this_worker, other_worker):
+            monkeypatch.setattr(server, "session_cache", cache)
+            await server._load_session_user("token")
+        fake_db.users.docs[0]["user_type"] = "pulperia"
+        await this_feed.invalidate_user("user_1")
+        stale = other_worker.get("token")
+        await other_feed.sync()
+        return stale
+
+    stale = asyncio.run(pick_type_then_sync())
+
+    assert stale is not None and stale.user_type is None
+    assert this_worker.get("token") is None
+    assert other_worker.get("token") is None
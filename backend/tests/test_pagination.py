@@ -0,0 +1,80 @@
+"""
+Keyset pagination over collections still mixing native-date and legacy ISO-string
+timestamps (before `python server.py migrate-datetimes` has run):
+    cd backend && python -m pytest -q tests/test_pagination.py
+"""
+import asyncio
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from conftest import FakeDatabase
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+# Three legacy rows written as ISO strings, then three with native dates
+ORDERS = [
+    {"order_id": f"order_{i}", "created_at": (START + timedelta(days=i)).isoformat() if i < 3 else START + timedelta(days=i)}
+    for i in range(6)
+]
+
+
+def all_pages(collection, direction):
+    async def walk():
+        cursor, pages = None, []
+        while True:
+            response = server.Response()
+            pages.append(await server.find_page(collection, {}, [("created_at", direction)], "order_id", 2, cursor, response))
+            cursor = response.headers.get(server.NEXT_CURSOR_HEADER)
+            if not cursor:
+                return pages
+    return asyncio.run(walk())
+
+
+@pytest.mark.parametrize("direction", [-1, 1])
+def test_pages_cross_from_dates_to_legacy_strings(direction):
+    collection = FakeDatabase({"orders": ORDERS}).orders
+
+    pages = all_pages(collection, direction)
+
+    order_ids = [doc["order_id"] for page in pages for doc in page]
+    # BSON order: every string sorts before every date
+    expected = [f"order_{i}" for i in range(6)]
+    assert order_ids == (expected[::-1] if direction == -1 else expected)
+    assert [len(page) for page in pages] == [2, 2, 2]
+
+
+def raw_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("values", [
+    [{"$regex": "(a+)+$"}, "order_1"],
+    [{"$dt": 5}, "order_1"],
+    [{"$dt": "yesterday"}, "order_1"],
+    [True, "order_1"],
+    [["nested"], "order_1"],
+    ["only one value"],
+])
+def test_malformed_cursor_values_are_rejected(values):
+    with pytest.raises(server.HTTPException) as exc:
+        server.decode_cursor(raw_cursor(values), 2)
+
+    assert exc.value.status_code == 400
+
+
+def test_cursor_round_trips_every_sort_key_type():
+    values = [START, "order_1", 4.5, 3, None]
+
+    assert server.decode_cursor(server.encode_cursor(values), len(values)) == values
+
+
+def test_proximity_cursor_needs_a_numeric_distance(monkeypatch):
+    monkeypatch.setattr(server, "db", FakeDatabase())
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.get_pulperias(server.Response(), lat=14.07, lng=-87.19, cursor=raw_cursor(["far", "p1"])))
+
+    assert exc.value.status_code == 400
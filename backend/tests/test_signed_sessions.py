@@ -0,0 +1,97 @@
+"""
+Signed session tokens (SESSION_MODE=signed): verified with zero database reads,
+tamper/expiry checks, and logout revocations synced between workers:
+    cd backend && python -m pytest -q tests/test_signed_sessions.py
+"""
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import server
+from conftest import FakeDatabase
+
+USER_DOC = {
+    "user_id": "user_000000000001",
+    "email": "owner@example.com",
+    "name": "Doña Marta",
+    "picture": None,
+    "user_type": "pulperia",
+    "created_at": server.utc_now()
+}
+
+
+@pytest.fixture
+def signed_mode(monkeypatch):
+    signer = server.SessionSigner("test-signing-key")
+    monkeypatch.setattr(server, "session_signer", signer)
+    monkeypatch.setattr(server, "revoked_sessions", server.RevocationList())
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(server, "db", fake_db)
+    return signer, fake_db
+
+
+def test_signed_token_is_verified_without_database(signed_mode):
+    signer, fake_db = signed_mode
+    token, _ = signer.issue(USER_DOC)
+
+    async def validate():
+        return [await server.validate_session_token(token) for _ in range(1000)]
+
+    users = asyncio.run(validate())
+
+    assert all(user.user_id == USER_DOC["user_id"] and user.user_type == "pulperia" for user in users)
+    assert users[0].name == USER_DOC["name"]
+    assert not fake_db.ops
+
+
+@pytest.mark.parametrize("forge", [
+    lambda token, signer: token[:10] + ("A" if token[10] != "A" else "B") + token[11:],
+    lambda token, signer: server.SessionSigner("another-key").issue(USER_DOC)[0],
+    lambda token, signer: server.SessionSigner("test-signing-key", ttl=timedelta(seconds=-1)).issue(USER_DOC)[0],
+    lambda token, signer: token + ".extra",
+    lambda token, signer: token.rsplit(".", 1)[0] + ".é",
+])
+def test_forged_or_expired_tokens_are_rejected(signed_mode, forge):
+    signer, _ = signed_mode
+    token, _ = signer.issue(USER_DOC)
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.validate_session_token(forge(token, signer)))
+
+    assert exc.value.status_code == 401
+
+
+def test_logout_revocation_reaches_other_workers(signed_mode):
+    signer, fake_db = signed_mode
+    token, claims = signer.issue(USER_DOC)
+    other_worker = server.RevocationList()
+
+    async def logout_then_sync():
+        await server.logout(server.Response(), None, token)
+        await other_worker.sync()
+
+    asyncio.run(logout_then_sync())
+
+    with pytest.raises(server.HTTPException):
+        asyncio.run(server.validate_session_token(token))
+    assert other_worker.is_revoked(claims["jti"])
+    assert other_worker.stats() == {"revoked": 1}
+    assert len(fake_db.revoked_sessions.docs) == 1
+
+
+def test_bearer_client_receives_replacement_token_on_set_user_type(signed_mode):
+    signer, fake_db = signed_mode
+    fake_db.users.docs.append({**USER_DOC, "user_type": None})
+    token, claims = signer.issue({**USER_DOC, "user_type": None})
+
+    async def choose_type():
+        updated = await server.set_user_type("pulperia", server.Response(), f"Bearer {token}", None)
+        return updated, await server.get_current_user(f"Bearer {updated['session_token']}", None)
+
+    updated, user = asyncio.run(choose_type())
+
+    assert updated["user_type"] == "pulperia"
+    assert user.user_id == USER_DOC["user_id"] and user.user_type == "pulperia"
+    with pytest.raises(server.HTTPException):
+        asyncio.run(server.validate_session_token(token))
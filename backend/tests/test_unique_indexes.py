@@ -0,0 +1,104 @@
+"""
+Unique indexes declared over collections that already hold duplicates: legacy rows
+are deduped first and the old index is never dropped unless the new one builds:
+    cd backend && python -m pytest -q tests/test_unique_indexes.py
+"""
+import asyncio
+from datetime import timedelta
+
+import pytest
+from pymongo import ASCENDING, IndexModel
+
+import server
+from conftest import FakeDatabase
+
+REVIEW_KEY = [("pulperia_id", ASCENDING), ("user_id", ASCENDING)]
+REVIEW_INDEX = "pulperia_id_1_user_id_1"
+
+
+def legacy_reviews(monkeypatch):
+    """A reviews collection still carrying the old non-unique index and a double review"""
+    fake_db = FakeDatabase({"reviews": [
+        {"_id": 1, "pulperia_id": "p1", "user_id": "u1", "rating": 5, "created_at": 1},
+        {"_id": 2, "pulperia_id": "p1", "user_id": "u1", "rating": 1, "created_at": 2},
+        {"_id": 3, "pulperia_id": "p1", "user_id": "u2", "rating": 4, "created_at": 3},
+    ]})
+    fake_db.reviews.indexes[REVIEW_INDEX] = {"key": REVIEW_KEY, "unique": False}
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "INDEXES", {"reviews": [IndexModel(REVIEW_KEY, unique=True)]})
+    return fake_db
+
+
+def test_duplicates_are_removed_before_unique_rebuild(monkeypatch):
+    fake_db = legacy_reviews(monkeypatch)
+
+    async def dedupe_only():
+        # repair_rating_counters' $merge recount is beyond the fake; its dedupe step is what matters here
+        await server.dedupe_collection(server.db.reviews, ["pulperia_id", "user_id"], {"created_at": 1, "_id": 1})
+
+    monkeypatch.setattr(server, "repair_rating_counters", dedupe_only)
+
+    asyncio.run(server.ensure_indexes())
+
+    assert [doc["_id"] for doc in fake_db.reviews.docs] == [1, 3]
+    assert fake_db.reviews.indexes[REVIEW_INDEX] == {"key": REVIEW_KEY, "unique": True}
+
+
+@pytest.mark.parametrize("fail_after_drop", [False, True])
+def test_old_index_is_kept_when_unique_build_cannot_succeed(monkeypatch, fail_after_drop):
+    fake_db = legacy_reviews(monkeypatch)
+    monkeypatch.setattr(server, "UNIQUE_INDEX_DEDUPES", {})
+    if fail_after_drop:
+        # Duplicates written between the check and the build
+        async def no_duplicates(collection, keys):
+            return False
+        monkeypatch.setattr(server, "has_duplicates", no_duplicates)
+
+    asyncio.run(server.ensure_indexes())
+
+    assert len(fake_db.reviews.docs) == 3
+    assert fake_db.reviews.indexes[REVIEW_INDEX] == {"key": REVIEW_KEY, "unique": False}
+    assert fake_db.ops["reviews.drop_index"] == (1 if fail_after_drop else 0)
+
+
+def duplicate_sessions(monkeypatch):
+    now = server.utc_now()
+    fake_db = FakeDatabase({"user_sessions": [
+        {"_id": 1, "session_token": "token_a", "user_id": "u1", "expires_at": now},
+        {"_id": 2, "session_token": "token_a", "user_id": "u1", "expires_at": now + timedelta(days=7)},
+        {"_id": 3, "session_token": "token_b", "user_id": "u2", "expires_at": now},
+    ]})
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "INDEXES", {"user_sessions": server.INDEXES["user_sessions"][:1]})
+    return fake_db
+
+
+def test_duplicate_session_tokens_keep_the_longest_lived(monkeypatch):
+    fake_db = duplicate_sessions(monkeypatch)
+
+    asyncio.run(server.ensure_indexes())
+
+    assert sorted(doc["_id"] for doc in fake_db.user_sessions.docs) == [2, 3]
+    assert fake_db.user_sessions.indexes["session_token_1"]["unique"]
+
+
+def test_session_token_falls_back_to_non_unique_index_until_deduped(monkeypatch):
+    fake_db = duplicate_sessions(monkeypatch)
+    dedupes = dict(server.UNIQUE_INDEX_DEDUPES)
+
+    async def dedupe_fails():
+        pass
+
+    monkeypatch.setitem(server.UNIQUE_INDEX_DEDUPES, ("user_sessions", "session_token_1"), dedupe_fails)
+    asyncio.run(server.ensure_indexes())
+    degraded = asyncio.run(server.index_report())["user_sessions"]
+
+    assert set(fake_db.user_sessions.indexes) == {"session_token_1_nonunique"}
+    assert degraded["not_unique"] == ["session_token_1"] and degraded["undeclared"] == []
+
+    monkeypatch.setattr(server, "UNIQUE_INDEX_DEDUPES", dedupes)
+    asyncio.run(server.ensure_indexes())
+    repaired = asyncio.run(server.index_report())["user_sessions"]
+
+    assert set(fake_db.user_sessions.indexes) == {"session_token_1"}
+    assert repaired["not_unique"] == [] and repaired["missing"] == []
@@ -0,0 +1,90 @@
+"""
+Database round trips per write endpoint. Creates return the inserted document and
+updates use find_one_and_update, so no endpoint reads back what it just wrote:
+    cd backend && python -m pytest -q tests/test_write_round_trips.py
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from conftest import FakeDatabase
+
+OWNER = server.User(user_id="user_owner", email="owner@example.com", name="Owner",
+                    user_type="pulperia", created_at=datetime.now(timezone.utc))
+CUSTOMER = server.User(user_id="user_customer", email="customer@example.com", name="Customer",
+                       user_type="cliente", created_at=datetime.now(timezone.utc))
+
+
+FIXTURES = {
+    "users": [{"user_id": OWNER.user_id, "email": OWNER.email, "name": OWNER.name}],
+    "pulperias": [{"pulperia_id": "pulperia_1", "owner_user_id": OWNER.user_id, "name": "La Esquina"}],
+    "products": [{"product_id": "product_1", "pulperia_id": "pulperia_1", "name": "Café", "price": 45.0}],
+    "jobs": [{"job_id": "job_1", "employer_user_id": OWNER.user_id, "title": "Cajero"}],
+    "advertisements": [{"ad_id": "ad_1", "pulperia_id": "pulperia_1", "status": "expired", "duration_days": 7}],
+}
+
+PULPERIA = server.PulperiaCreate(name="La Esquina", address="Centro", location={"lat": 14.07, "lng": -87.19})
+PRODUCT = server.ProductCreate(name="Café", price=45.0)
+ORDER = server.OrderCreate(pulperia_id="pulperia_1", total=90.0, items=[
+    server.OrderItem(product_id="product_1", product_name="Café", quantity=2, price=45.0)
+])
+JOB = server.JobCreate(title="Cajero", description="Turno de tarde", category="ventas", pay_rate=80,
+                       pay_currency="HNL", location="Tegucigalpa", contact="9999-9999")
+SERVICE = server.ServiceCreate(title="Plomería", description="Reparaciones", category="hogar", hourly_rate=150,
+                               rate_currency="HNL", location="Tegucigalpa", contact="9999-9999")
+
+# (endpoint call, acting user, expected operations)
+ENDPOINTS = {
+    "create_pulperia": (lambda: server.create_pulperia(PULPERIA), OWNER,
+                        {"pulperias.insert_one": 1}),
+    "create_product": (lambda: server.create_product(PRODUCT, "pulperia_1"), OWNER,
+                       {"pulperias.find_one": 1, "products.insert_one": 1}),
+    "create_order": (lambda: server.create_order(ORDER), CUSTOMER,
+                     {"pulperias.find_one": 1, "orders.insert_one": 1}),
+    "create_job": (lambda: server.create_job(JOB), OWNER,
+                   {"jobs.insert_one": 1}),
+    "apply_to_job": (lambda: server.apply_to_job("job_1", server.JobApplicationCreate(contact="9999-9999")), CUSTOMER,
+                     {"jobs.find_one": 1, "job_applications.find_one": 1, "job_applications.insert_one": 1}),
+    "create_service": (lambda: server.create_service(SERVICE), CUSTOMER,
+                       {"services.insert_one": 1}),
+    "create_message": (lambda: server.create_message(server.MessageCreate(to_user_id=OWNER.user_id, message="Hola")), CUSTOMER,
+                       {"messages.insert_one": 1}),
+    "create_advertisement": (lambda: server.create_advertisement(server.AdvertisementCreate(plan="basico", payment_method="efectivo")), OWNER,
+                             {"pulperias.find_one": 1, "advertisements.find_one": 1, "advertisements.insert_one": 1}),
+    "create_review": (lambda: server.create_review("pulperia_1", server.ReviewCreate(rating=5)), CUSTOMER,
+                      {"pulperias.find_one": 1, "reviews.insert_one": 1, "pulperias.update_one": 1}),
+    "update_pulperia": (lambda: server.update_pulperia("pulperia_1", PULPERIA), OWNER,
+                        {"pulperias.find_one": 1, "pulperias.find_one_and_update": 1}),
+    "update_product": (lambda: server.update_product("product_1", PRODUCT), OWNER,
+                       {"products.find_one": 1, "pulperias.find_one": 1, "products.find_one_and_update": 1}),
+    "toggle_product_availability": (lambda: server.toggle_product_availability("product_1"), OWNER,
+                                    {"products.find_one": 1, "pulperias.find_one": 1, "products.find_one_and_update": 1}),
+    "activate_advertisement": (lambda: server.activate_advertisement("ad_1"), OWNER,
+                               {"advertisements.find_one": 1, "pulperias.find_one": 1, "advertisements.find_one_and_update": 1}),
+    "set_user_type": (lambda: server.set_user_type("pulperia", server.Response(), None, None), OWNER,
+                      {"users.find_one_and_update": 1, "session_invalidations.insert_one": 1}),
+}
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+def test_write_endpoint_round_trips(endpoint, monkeypatch):
+    call, user, expected_ops = ENDPOINTS[endpoint]
+    fake_db = FakeDatabase(FIXTURES)
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "pulperia_owner_cache", server.LRUCache())
+
+    async def current_user(*args, **kwargs):
+        return user
+
+    async def no_broadcast(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(server, "get_current_user", current_user)
+    monkeypatch.setattr(server, "broadcast_order_update", no_broadcast)
+
+    result = asyncio.run(call())
+
+    assert dict(fake_db.ops) == expected_ops
+    assert isinstance(result, dict) and "_id" not in result
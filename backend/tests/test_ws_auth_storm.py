@@ -0,0 +1,88 @@
+"""
+Reconnect-storm benchmark for the WebSocket handshake's session validation.
+After a deploy every phone reconnects at once; DB lookups must stay bounded by the
+number of distinct sessions, not the number of handshakes:
+    cd backend && python -m pytest -q -s tests/test_ws_auth_storm.py
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import server
+from conftest import FakeDatabase
+
+SESSIONS = 50
+HANDSHAKES = 2000
+DB_LATENCY_SECONDS = 0.005
+
+
+def session_fixtures():
+    now = datetime.now(timezone.utc)
+    return {
+        "users": [
+            {"user_id": f"user_{i:012d}", "email": f"user{i}@example.com", "name": f"User {i}", "created_at": now}
+            for i in range(SESSIONS)
+        ],
+        "user_sessions": [
+            {"user_id": f"user_{i:012d}", "session_token": f"token_{i}", "expires_at": now + timedelta(days=7)}
+            for i in range(SESSIONS)
+        ],
+    }
+
+
+def test_reconnect_storm_db_load_is_bounded(monkeypatch):
+    logging.getLogger("server").setLevel(logging.WARNING)
+    fake_db = FakeDatabase(session_fixtures(), latency=DB_LATENCY_SECONDS)
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "session_cache", server.SessionCache())
+
+    async def storm():
+        start = time.perf_counter()
+        users = await asyncio.gather(*(
+            server.validate_session_token(f"token_{i % SESSIONS}") for i in range(HANDSHAKES)
+        ))
+        return users, time.perf_counter() - start
+
+    users, elapsed = asyncio.run(storm())
+    db_reads = fake_db.ops["user_sessions.find_one"] + fake_db.ops["users.find_one"]
+
+    print(f"\n🔌 {HANDSHAKES} handshakes over {SESSIONS} sessions: {elapsed * 1000:.1f} ms, "
+          f"{db_reads} DB reads (uncached would be {2 * HANDSHAKES})")
+
+    assert all(user.user_id == f"user_{i % SESSIONS:012d}" for i, user in enumerate(users))
+    assert fake_db.ops["user_sessions.find_one"] == SESSIONS
+    assert fake_db.ops["users.find_one"] == SESSIONS
+
+
+def test_invalid_token_is_rejected_once_per_storm(monkeypatch):
+    fake_db = FakeDatabase(session_fixtures(), latency=DB_LATENCY_SECONDS)
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "session_cache", server.SessionCache())
+
+    async def storm():
+        return await asyncio.gather(
+            *(server.validate_session_token("token_unknown") for _ in range(100)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(storm())
+
+    assert all(isinstance(r, server.HTTPException) and r.status_code == 401 for r in results)
+    assert fake_db.ops["user_sessions.find_one"] == 1
+
+
+@pytest.mark.parametrize("query, code", [("", 4001), ("?token=unknown", 4001), ("?token=token_1", 4003)])
+def test_rejected_handshake_reports_close_code(monkeypatch, query, code):
+    monkeypatch.setattr(server, "db", FakeDatabase(session_fixtures()))
+    monkeypatch.setattr(server, "session_cache", server.SessionCache())
+
+    with TestClient(server.app).websocket_connect(f"/ws/orders/user_000000000000{query}") as websocket:
+        with pytest.raises(WebSocketDisconnect) as exc:
+            websocket.receive_text()
+
+    assert exc.value.code == code
@@ -0,0 +1,87 @@
+"""
+Per-socket outboxes: a client that stops reading is evicted (outbox full or send
+timeout) without holding up the other sockets, and eviction is idempotent:
+    cd backend && python -m pytest -q tests/test_ws_backpressure.py
+"""
+import asyncio
+
+import server
+from conftest import FakeWebSocket
+
+USER_ID = "user_1"
+
+
+async def drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+async def connected_manager(*websockets):
+    manager = server.ConnectionManager()
+    await manager.start()
+    for websocket in websockets:
+        await manager.connect(websocket, USER_ID)
+    return manager
+
+
+async def shut_down(manager, *websockets):
+    for websocket in websockets:
+        manager.disconnect(websocket, USER_ID)
+    await manager.stop()
+
+
+def test_full_outbox_evicts_only_the_stalled_socket():
+    async def run():
+        healthy, stalled = FakeWebSocket(), FakeWebSocket(stalled=True)
+        manager = await connected_manager(healthy, stalled)
+        # One frame stuck in send_text plus a full queue, then one more
+        for i in range(server.WS_SEND_QUEUE_SIZE + 2):
+            await manager.broadcast_to_user(USER_ID, {"type": "order_update", "n": i})
+            await drain()
+        await shut_down(manager, healthy)
+        return manager, healthy, stalled
+
+    manager, healthy, stalled = asyncio.run(run())
+
+    assert len(healthy.frames) == server.WS_SEND_QUEUE_SIZE + 2
+    assert stalled.close_codes == [server.WS_CLOSE_SLOW_CONSUMER]
+    assert manager.evictions == 1
+    assert stalled not in manager.clients
+
+
+def test_send_timeout_evicts(monkeypatch):
+    monkeypatch.setattr(server, "WS_SEND_TIMEOUT_SECONDS", 0.01)
+
+    async def run():
+        stalled = FakeWebSocket(stalled=True)
+        manager = await connected_manager(stalled)
+        await manager.broadcast_to_user(USER_ID, {"type": "order_update"})
+        await asyncio.sleep(0.05)
+        await manager.stop()
+        return manager, stalled
+
+    manager, stalled = asyncio.run(run())
+
+    assert stalled.close_codes == [server.WS_CLOSE_SLOW_CONSUMER]
+    assert manager.evictions == 1
+    assert not manager.is_user_connected(USER_ID)
+
+
+def test_evict_twice_closes_once():
+    async def run():
+        websocket = FakeWebSocket()
+        manager = await connected_manager(websocket)
+        client = manager.clients[websocket]
+        manager.evict(client, "outbox full")
+        manager.evict(client, "send timed out")
+        manager.disconnect(websocket, USER_ID)
+        await drain()
+        await manager.stop()
+        return manager, websocket, client
+
+    manager, websocket, client = asyncio.run(run())
+
+    assert websocket.close_codes == [server.WS_CLOSE_SLOW_CONSUMER]
+    assert manager.evictions == 1
+    assert client.writer.done()
+    assert manager.stats()["connections"] == 0 and manager.subscriptions == {}
@@ -0,0 +1,186 @@
+"""
+WebSocket fan-out micro-benchmark: one notification to 1,000 sockets of the same user.
+Runs in-process against fake sockets, no server or database needed:
+    cd backend && python -m pytest -q -s tests/test_ws_fanout.py
+"""
+import asyncio
+import json
+import logging
+import time
+
+import pytest
+
+import server
+from conftest import FakeWebSocket
+
+SOCKETS = 1000
+
+ORDER_NOTIFICATION = {
+    "type": "order_update",
+    "event": "new_order",
+    "target": "owner",
+    "order": {
+        "order_id": "order_0123456789ab",
+        "customer_user_id": "user_customer01",
+        "pulperia_id": "pulperia_0123456789",
+        "items": [
+            {"product_id": f"product_{i:012d}", "product_name": "Café Molido 250g", "quantity": 2, "price": 45.0}
+            for i in range(10)
+        ],
+        "total": 900.0,
+        "status": "pending",
+        "order_type": "pickup",
+        "created_at": "2025-01-01T12:00:00+00:00"
+    },
+    "message": "🔔 ¡Nueva orden #6789ab! Total: L900.00",
+    "sound": True
+}
+
+
+async def fan_out(manager, sockets, message):
+    start = time.perf_counter()
+    await manager.broadcast_to_user("user_owner", message)
+    while any(not ws.frames for ws in sockets):
+        await asyncio.sleep(0)
+    return time.perf_counter() - start
+
+
+def test_fanout_to_1000_sockets_serializes_once(monkeypatch):
+    logging.getLogger("server").setLevel(logging.WARNING)
+    encoded = []
+    real_encode_frame = server.encode_frame
+    monkeypatch.setattr(server, "encode_frame", lambda message: encoded.append(message) or real_encode_frame(message))
+
+    async def run():
+        manager = server.ConnectionManager()
+        await manager.start()
+        sockets = [FakeWebSocket() for _ in range(SOCKETS)]
+        for ws in sockets:
+            await manager.connect(ws, "user_owner")
+
+        elapsed = await fan_out(manager, sockets, ORDER_NOTIFICATION)
+
+        for ws in sockets:
+            manager.disconnect(ws, "user_owner")
+        return sockets, elapsed
+
+    sockets, elapsed = asyncio.run(run())
+
+    # Baseline: what per-socket send_json used to cost in serialization alone
+    start = time.perf_counter()
+    for _ in range(SOCKETS):
+        json.dumps(ORDER_NOTIFICATION, separators=(",", ":"), ensure_ascii=False)
+    per_socket_dumps = time.perf_counter() - start
+
+    print(f"\n📤 Fan-out to {SOCKETS} sockets: {elapsed * 1000:.2f} ms "
+          f"(per-socket json.dumps alone: {per_socket_dumps * 1000:.2f} ms)")
+
+    assert len(encoded) == 1
+    first_frame = sockets[0].frames[0]
+    assert all(len(ws.frames) == 1 and ws.frames[0] is first_frame for ws in sockets)
+    assert json.loads(first_frame) == {**ORDER_NOTIFICATION, "topic": "user:user_owner", "seq": 1}
+
+
+def test_socket_following_overlapping_topics_gets_one_frame_per_audience(monkeypatch):
+    order = {"order_id": "o1", "pulperia_id": "p1", "owner_user_id": "owner", "customer_user_id": "customer",
+             "items": [], "total": 45.0, "status": "pending"}
+
+    async def run():
+        manager = server.ConnectionManager()
+        monkeypatch.setattr(server, "ws_manager", manager)
+        await manager.start()
+        owner, customer = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(owner, "owner")
+        await manager.connect(customer, "customer")
+        for websocket, topic in ((owner, "pulperia:p1"), (customer, "order:o1")):
+            manager.subscribe(websocket, topic)
+            await manager.event_log.track(topic)
+
+        await server.broadcast_order_update(order, "new_order")
+        # Nobody follows order:o2, so nothing is logged for it
+        await server.broadcast_order_update({**order, "order_id": "o2"}, "new_order")
+        await asyncio.sleep(0.01)
+        manager.heartbeat.stop()
+        return owner, customer, manager
+
+    owner, customer, manager = asyncio.run(run())
+
+    owner_frames = [json.loads(frame) for frame in owner.frames]
+    customer_frames = [json.loads(frame) for frame in customer.frames]
+    assert [(f["target"], f["order"]["order_id"], f["topic"], f["seq"]) for f in owner_frames] == [
+        ("owner", "o1", "user:owner", 1), ("owner", "o2", "user:owner", 2)]
+    assert [(f["target"], f["order"]["order_id"]) for f in customer_frames] == [
+        ("customer", "o1"), ("customer", "o2")]
+    assert "order:o2" not in manager.event_log._topics
+
+
+@pytest.mark.parametrize("broker, store, expected", [
+    ("memory", None, server.InMemoryEventLog),
+    ("redis", None, server.MongoEventLog),
+    ("mongo", None, server.MongoEventLog),
+    ("redis", "memory", RuntimeError),
+])
+def test_cross_worker_broker_needs_shared_replay_store(monkeypatch, broker, store, expected):
+    monkeypatch.setenv("WS_BROKER", broker)
+    if store:
+        monkeypatch.setenv("WS_REPLAY_STORE", store)
+    else:
+        monkeypatch.delenv("WS_REPLAY_STORE", raising=False)
+
+    if expected is RuntimeError:
+        with pytest.raises(RuntimeError):
+            server.create_ws_event_log()
+    else:
+        assert isinstance(server.create_ws_event_log(), expected)
+
+
+class FlakyRedis:
+    """Pub/sub whose first connection drops mid-listen; later ones replay `messages`"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.subscriptions = 0
+
+    def pubsub(self):
+        redis = self
+
+        class PubSub:
+            async def subscribe(self, channel):
+                redis.subscriptions += 1
+
+            async def listen(self):
+                if redis.subscriptions == 1:
+                    raise ConnectionError("Connection closed by server.")
+                for message in redis.messages:
+                    yield message
+                await asyncio.Event().wait()
+
+            async def reset(self):
+                pass
+
+            async def unsubscribe(self, channel):
+                pass
+
+        return PubSub()
+
+
+def test_redis_reader_resubscribes_after_disconnect(monkeypatch):
+    entries = [["user:owner", 1, '{"type":"order_update","topic":"user:owner","seq":1}']]
+    redis = FlakyRedis([{"type": "subscribe"}, {"type": "message", "data": json.dumps({"entries": entries})}])
+    delivered = []
+
+    async def deliver(event):
+        delivered.append(event)
+
+    async def run():
+        broker = server.RedisBroker(redis_client=redis)
+        broker.retry_seconds = 0
+        await broker.start(deliver)
+        while not delivered:
+            await asyncio.sleep(0)
+        await broker.stop()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=1))
+
+    assert redis.subscriptions == 2
+    assert delivered == [[tuple(entries[0])]]
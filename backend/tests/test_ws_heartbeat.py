@@ -0,0 +1,77 @@
+"""
+Heartbeat wheel, driven tick by tick: idle sockets are reaped with WS_CLOSE_IDLE,
+inbound traffic keeps a socket alive, and a ping that finds the outbox full evicts:
+    cd backend && python -m pytest -q tests/test_ws_heartbeat.py
+"""
+import asyncio
+import json
+import time
+
+import server
+from conftest import FakeWebSocket
+
+USER_ID = "user_1"
+IDLE_TIMEOUT_SECONDS = 90
+
+
+async def drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def run_ticks(websocket, before_tick):
+    """Connect `websocket` to a one-slot wheel, let `before_tick` set it up, then tick once"""
+    async def run():
+        manager = server.ConnectionManager()
+        manager.heartbeat = server.HeartbeatWheel(manager, interval_seconds=1,
+                                                  idle_timeout_seconds=IDLE_TIMEOUT_SECONDS, slots=1)
+        await manager.connect(websocket, USER_ID)
+        client = manager.clients[websocket]
+        before_tick(client)
+        manager.heartbeat.tick()
+        await drain()
+        manager.disconnect(websocket, USER_ID)
+        return manager
+
+    return asyncio.run(run())
+
+
+def go_idle(client):
+    client.last_seen = time.monotonic() - IDLE_TIMEOUT_SECONDS - 1
+
+
+def test_idle_socket_is_reaped():
+    websocket = FakeWebSocket()
+
+    manager = run_ticks(websocket, go_idle)
+
+    assert websocket.close_codes == [server.WS_CLOSE_IDLE]
+    assert websocket.frames == []
+    assert manager.heartbeat.reaped == 1 and manager.evictions == 0
+
+
+def test_inbound_traffic_keeps_socket_alive():
+    websocket = FakeWebSocket()
+
+    def idle_then_touch(client):
+        go_idle(client)
+        client.touch()
+
+    manager = run_ticks(websocket, idle_then_touch)
+
+    assert websocket.close_codes == []
+    assert [json.loads(frame) for frame in websocket.frames] == [{"type": "ping"}]
+    assert manager.heartbeat.reaped == 0
+
+
+def test_ping_on_full_outbox_evicts():
+    websocket = FakeWebSocket(stalled=True)
+
+    def fill_outbox(client):
+        while client.enqueue("{}"):
+            pass
+
+    manager = run_ticks(websocket, fill_outbox)
+
+    assert websocket.close_codes == [server.WS_CLOSE_SLOW_CONSUMER]
+    assert manager.evictions == 1 and manager.heartbeat.reaped == 0
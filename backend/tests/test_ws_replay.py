@@ -0,0 +1,133 @@
+"""
+Resumable WebSocket streams: a reconnect with last_seq gets exactly the frames it
+missed, in order; a gap the replay log no longer covers asks the client to resync;
+live events arriving mid-replay are neither duplicated nor reordered:
+    cd backend && python -m pytest -q tests/test_ws_replay.py
+"""
+import asyncio
+import json
+
+from starlette.testclient import TestClient
+
+import server
+from conftest import FakeWebSocket
+
+USER = server.User(user_id="user_1", email="user1@example.com", name="User", created_at=server.utc_now())
+TOPIC = server.user_topic(USER.user_id)
+
+
+def seqs(websocket):
+    return [json.loads(frame)["seq"] for frame in websocket.frames]
+
+
+async def drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+async def publish(manager, count, start=1):
+    for i in range(start, start + count):
+        await manager.broadcast_to_user(USER.user_id, {"type": "order_update", "n": i})
+
+
+def handshake(monkeypatch, manager, last_seq):
+    """Connect through the real endpoint; every message it sends before answering a ping"""
+    async def validate(token):
+        return USER
+
+    monkeypatch.setattr(server, "validate_session_token", validate)
+    monkeypatch.setattr(server, "ws_manager", manager)
+    with TestClient(server.app).websocket_connect(f"/ws/orders/{USER.user_id}?token=t&last_seq={last_seq}") as websocket:
+        websocket.send_json({"type": "ping"})
+        messages = []
+        while not messages or messages[-1]["type"] != "pong":
+            messages.append(websocket.receive_json())
+        return messages[:-1]
+
+
+def test_reconnect_receives_exactly_the_missed_frames(monkeypatch):
+    manager = server.ConnectionManager()
+
+    async def before_reconnect():
+        await manager.start()
+        first = FakeWebSocket()
+        await manager.connect(first, USER.user_id)
+        await publish(manager, 5)
+        await drain()
+        manager.disconnect(first, USER.user_id)
+        await manager.stop()
+        return first
+
+    first = asyncio.run(before_reconnect())
+    connected, *replayed = handshake(monkeypatch, manager, last_seq=2)
+
+    assert seqs(first) == [1, 2, 3, 4, 5]
+    assert connected["type"] == "connected" and connected["seq"] == 5
+    assert replayed == [json.loads(frame) for frame in first.frames[2:]]
+    assert [message["n"] for message in replayed] == [3, 4, 5]
+
+
+def test_gap_beyond_replay_log_requires_resync(monkeypatch):
+    manager = server.ConnectionManager(event_log=server.InMemoryEventLog(buffer_size=3))
+
+    async def fill_log():
+        await manager.start()
+        await manager.event_log.track(TOPIC)
+        await publish(manager, 6)
+        await manager.stop()
+
+    asyncio.run(fill_log())
+    connected, *replies = handshake(monkeypatch, manager, last_seq=1)
+
+    assert connected["seq"] == 6
+    # Nothing partial is replayed: the client refetches instead
+    assert replies == [{"type": "resync_required", "topic": TOPIC}]
+
+
+class GatedEventLog(server.InMemoryEventLog):
+    """since() pauses before and after reading the log, so events can land mid-replay"""
+
+    def __init__(self):
+        super().__init__()
+        self.before_read, self.after_read = asyncio.Event(), asyncio.Event()
+        self.waiting = asyncio.Event()
+
+    async def since(self, topic, last_seq):
+        self.waiting.set()
+        await self.before_read.wait()
+        missed = await super().since(topic, last_seq)
+        self.waiting.clear()
+        await self.after_read.wait()
+        return missed
+
+
+def test_live_events_during_replay_are_not_duplicated_or_reordered():
+    async def run():
+        event_log = GatedEventLog()
+        manager = server.ConnectionManager(event_log=event_log)
+        await manager.start()
+        await manager.event_log.track(TOPIC)
+        await publish(manager, 3)
+
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, USER.user_id)
+        resume = asyncio.create_task(manager.resume(websocket, TOPIC, 1))
+        await event_log.waiting.wait()
+        # Logged before the replay reads the log: it is replayed, so the held copy must be dropped
+        await publish(manager, 1, start=4)
+        event_log.before_read.set()
+        await drain()
+        # Logged after the read: only the held copy delivers it, after the replay
+        await publish(manager, 1, start=5)
+        event_log.after_read.set()
+        resumed = await resume
+        await publish(manager, 1, start=6)
+        await drain()
+        manager.disconnect(websocket, USER.user_id)
+        await manager.stop()
+        return websocket, resumed
+
+    websocket, resumed = asyncio.run(run())
+
+    assert resumed
+    assert seqs(websocket) == [2, 3, 4, 5, 6]
@@ -0,0 +1,110 @@
+"""
+Topic subscriptions: a user may only follow their own stream, pulperías they own and
+orders they are party to; each socket holds a bounded number of topics, and the
+user's own topic cannot be dropped:
+    cd backend && python -m pytest -q tests/test_ws_subscriptions.py
+"""
+import asyncio
+
+import pytest
+from starlette.testclient import TestClient
+
+import server
+from conftest import FakeDatabase
+
+OWNER = server.User(user_id="owner_1", email="owner@example.com", name="Owner", created_at=server.utc_now())
+CUSTOMER = server.User(user_id="customer_1", email="customer@example.com", name="Customer", created_at=server.utc_now())
+STRANGER = server.User(user_id="stranger_1", email="stranger@example.com", name="Stranger", created_at=server.utc_now())
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake_db = FakeDatabase({
+        "pulperias": [{"pulperia_id": "pulp_1", "owner_user_id": OWNER.user_id}],
+        "orders": [
+            {"order_id": "order_1", "customer_user_id": CUSTOMER.user_id, "pulperia_id": "pulp_1",
+             "owner_user_id": OWNER.user_id},
+            # Older orders carry no owner_user_id; the owner comes from the pulpería
+            {"order_id": "order_2", "customer_user_id": CUSTOMER.user_id, "pulperia_id": "pulp_1"},
+        ],
+    })
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "pulperia_owner_cache", server.LRUCache())
+    return fake_db
+
+
+@pytest.mark.parametrize("user, topic, allowed", [
+    (OWNER, "user:owner_1", True),
+    (OWNER, "user:customer_1", False),
+    (OWNER, "pulperia:pulp_1", True),
+    (CUSTOMER, "pulperia:pulp_1", False),
+    (STRANGER, "pulperia:pulp_missing", False),
+    (CUSTOMER, "order:order_1", True),
+    (OWNER, "order:order_1", True),
+    (OWNER, "order:order_2", True),
+    (STRANGER, "order:order_1", False),
+    (STRANGER, "order:order_2", False),
+    (CUSTOMER, "order:order_missing", False),
+    (OWNER, "user:", False),
+    (OWNER, "admin:everything", False),
+])
+def test_can_subscribe(fake_db, user, topic, allowed):
+    assert asyncio.run(server.can_subscribe(user, topic)) is allowed
+
+
+def converse(monkeypatch, user, messages):
+    """Send `messages` through the real endpoint and return one reply per message"""
+    async def validate(token):
+        return user
+
+    manager = server.ConnectionManager()
+    monkeypatch.setattr(server, "validate_session_token", validate)
+    monkeypatch.setattr(server, "ws_manager", manager)
+    with TestClient(server.app).websocket_connect(f"/ws/orders/{user.user_id}?token=t") as websocket:
+        assert websocket.receive_json()["type"] == "connected"
+        replies = []
+        for message in messages:
+            websocket.send_json(message)
+            replies.append(websocket.receive_json())
+        websocket.send_json({"type": "ping"})
+        assert websocket.receive_json()["type"] == "pong"
+        topics = {topic for topic, sockets in manager.subscriptions.items() if sockets}
+    return replies, topics
+
+
+def test_foreign_topics_are_refused(fake_db, monkeypatch):
+    replies, topics = converse(monkeypatch, STRANGER, [
+        {"type": "subscribe", "topic": "user:owner_1"},
+        {"type": "subscribe", "topic": "pulperia:pulp_1"},
+        {"type": "subscribe", "topic": "order:order_1"},
+    ])
+
+    assert [(reply["type"], reply["detail"]) for reply in replies] == [("subscribe_error", "Not authorized")] * 3
+    assert topics == {"user:stranger_1"}
+
+
+def test_topics_per_connection_are_capped(fake_db, monkeypatch):
+    monkeypatch.setattr(server, "WS_MAX_TOPICS_PER_CONNECTION", 2)
+
+    replies, topics = converse(monkeypatch, OWNER, [
+        {"type": "subscribe", "topic": "pulperia:pulp_1"},
+        {"type": "subscribe", "topic": "order:order_1"},
+        # Re-subscribing to a topic already held does not count against the cap
+        {"type": "subscribe", "topic": "pulperia:pulp_1"},
+    ])
+
+    assert replies[0]["type"] == "subscribed" and replies[2]["type"] == "subscribed"
+    assert replies[1] == {"type": "subscribe_error", "topic": "order:order_1", "detail": "Too many subscriptions"}
+    assert topics == {"user:owner_1", "pulperia:pulp_1"}
+
+
+def test_own_user_topic_cannot_be_unsubscribed(fake_db, monkeypatch):
+    replies, topics = converse(monkeypatch, OWNER, [
+        {"type": "subscribe", "topic": "pulperia:pulp_1"},
+        {"type": "unsubscribe", "topic": "pulperia:pulp_1"},
+        {"type": "unsubscribe", "topic": "user:owner_1"},
+    ])
+
+    assert replies[1] == {"type": "unsubscribed", "topic": "pulperia:pulp_1"}
+    assert replies[2] == {"type": "unsubscribed", "topic": "user:owner_1"}
+    assert topics == {"user:owner_1"}